@@ -0,0 +1,286 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from clock import VirtualClock
+from controller import Controller
+from ds18b20 import DS18B20, w1_slave_text
+
+#####################################################################################
+###  Benchmarks
+###
+###  python bench.py                              run everything, write bench.json
+###  python bench.py --output new.json --baseline bench.json
+###
+###  - command latency: cmd/bubbler_1 handed to the controller as if from the
+###    broker, until the output write and until the state/ publish
+###  - main loop cost per tick: one changed air reading plus a timer pass, on
+###    a virtual clock so nothing sleeps
+###  - sensor sweep time for N fake DS18B20s in a temp sysfs tree
+###  - savedata.json writes per command
+###
+###  with --baseline, any result more than --tolerance worse than the baseline
+###  is listed and the exit status is 1
+#####################################################################################
+
+SITE = "bench"
+
+
+class LocalBroker:
+    """In-process stand-in for the paho client and the broker behind it"""
+
+    def __init__(self):
+        self.on_connect = None
+        self.on_message = None
+        self.published = 0
+        self._waiting = {}          # (topic, payload) -> Event
+        self._lock = threading.Lock()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        with self._lock:
+            self.published += 1
+            waiter = self._waiting.pop((topic, payload), None)
+        if waiter:
+            waiter.at = time.perf_counter()
+            waiter.set()
+
+    def subscribe(self, topics):
+        pass
+
+    def expect(self, topic, payload):
+        """Event that is set when topic/payload is next published"""
+        waiter = threading.Event()
+        with self._lock:
+            self._waiting[(topic, payload)] = waiter
+        return waiter
+
+    def deliver(self, topic, payload):
+        """A message arriving from the broker, on the caller's thread like paho's network loop"""
+        message = SimpleNamespace(topic=topic, payload=payload.encode("utf-8"))
+        self.on_message(self, None, message)
+
+
+def percentiles(samples, scale=1000.0):
+    """p50/p90/p99/max of a list of seconds, in ms by default"""
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    def at(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * scale, 3)
+    return {"p50": at(0.50), "p90": at(0.90), "p99": at(0.99), "max": round(samples[-1] * scale, 3)}
+
+
+def _subdir(workdir, name):
+    path = os.path.join(workdir, name)
+    os.makedirs(path)
+    return path
+
+
+def _site_settings(workdir, backend):
+    savefile = os.path.join(workdir, "savedata.json")
+    with open(savefile, "w") as f:
+        json.dump({"mainkey": 1, "autokey": 0}, f)
+    return {"backend": backend, "savefile": savefile, "eventlog": None, "templog": None,
+            "suntable": os.path.join(workdir, "suntable.bin")}
+
+
+#################################################################################
+###  The benchmarks
+#################################################################################
+
+def bench_command_latency(workdir, commands=500):
+    """cmd/bubbler_1 ON/OFF round trips through the real main loop"""
+    broker = LocalBroker()
+    ctl = Controller(broker, "bench-gw")
+    site = ctl.add_site(SITE, **_site_settings(workdir, "mock"))
+    threading.Thread(target=ctl.run, daemon=True).start()
+    time.sleep(0.1)
+
+    to_gpio, to_publish = [], []
+    writes = site.store.writes
+    gpio_writes = site.outputs.writes
+    for i in range(commands):
+        payload = "ON" if i % 2 == 0 else "OFF"
+        published = broker.expect(f"{SITE}/state/bubbler_1", payload)
+        start = time.perf_counter()
+        broker.deliver(f"{SITE}/cmd/bubbler_1", payload)
+        if not published.wait(5):
+            raise RuntimeError(f"no state/bubbler_1 {payload} after 5s")
+        to_gpio.append(site.outputs.written_at - start)
+        to_publish.append(published.at - start)
+    site.store.flush()
+
+    return {
+        "commands": commands,
+        "cmd_to_gpio_ms": percentiles(to_gpio),
+        "cmd_to_state_publish_ms": percentiles(to_publish),
+        "savedata_writes_per_command": round((site.store.writes - writes) / commands, 4),
+        "gpio_writes_per_command": round((site.outputs.writes - gpio_writes) / commands, 4),
+    }
+
+
+def bench_swap(workdir, swaps=500):
+    """cmd/batch bubbler swaps: one grouped output write each"""
+    broker = LocalBroker()
+    ctl = Controller(broker, "bench-gw")
+    site = ctl.add_site(SITE, **_site_settings(workdir, "mock"))
+    threading.Thread(target=ctl.run, daemon=True).start()
+    time.sleep(0.1)
+    started = broker.expect(f"{SITE}/state/bubbler_1", "ON")
+    broker.deliver(f"{SITE}/cmd/bubbler_1", "ON")
+    started.wait(5)
+
+    to_gpio = []
+    gpio_writes = site.outputs.writes
+    for i in range(swaps):
+        on, off = ("bubbler_2", "bubbler_1") if i % 2 == 0 else ("bubbler_1", "bubbler_2")
+        published = broker.expect(f"{SITE}/state/{on}", "ON")
+        start = time.perf_counter()
+        broker.deliver(f"{SITE}/cmd/batch", json.dumps({off: "OFF", on: "ON"}))
+        if not published.wait(5):
+            raise RuntimeError(f"no state/{on} ON after 5s")
+        to_gpio.append(site.outputs.written_at - start)
+    site.store.flush()
+
+    return {
+        "swaps": swaps,
+        "cmd_to_gpio_ms": percentiles(to_gpio),
+        "gpio_writes_per_swap": round((site.outputs.writes - gpio_writes) / swaps, 4),
+    }
+
+
+def bench_tick(workdir, ticks=20000):
+    """CPU for one main loop tick: a changed air temp and a timer pass"""
+    clock = VirtualClock(time.time())
+    ctl = Controller(LocalBroker(), "bench-gw", clock=clock)
+    site = ctl.add_site(SITE, **_site_settings(workdir, "mock"))
+    ctl.start()
+
+    walls = []
+    cpu = time.process_time()
+    for i in range(ticks):
+        clock.set(clock.time() + 2)
+        start = time.perf_counter()
+        site.record(clock.time(), 1.0 + (i % 7) / 10, 2.0, 8.0)
+        while not ctl.q.empty():
+            ctl.dispatch(*ctl.q.get_nowait())
+        ctl.run_timers()
+        walls.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+    site.store.flush()
+
+    return {
+        "ticks": ticks,
+        "cpu_us_per_tick": round(cpu / ticks * 1e6, 2),
+        "tick_us": percentiles(walls, scale=1e6),
+    }
+
+
+def _fake_w1(base, devices):
+    for i in range(devices):
+        path = os.path.join(base, f"28-{i:012x}")
+        os.makedirs(path)
+        with open(os.path.join(path, "w1_slave"), "w") as f:
+            f.write(w1_slave_text(-1.0 * i - 0.125))
+
+
+def bench_sweep(workdir, device_counts=(3, 10, 30), sweeps=200):
+    """Time to read N sensors once (no bulk conversion, the files answer instantly)"""
+    results = {}
+    for devices in device_counts:
+        base = os.path.join(workdir, f"w1-{devices}") + "/"
+        _fake_w1(base, devices)
+        sensor = DS18B20(base, bulk=False)
+        times = []
+        for _ in range(sweeps):
+            start = time.perf_counter()
+            sensor.sweep()
+            times.append(time.perf_counter() - start)
+        results[str(devices)] = percentiles(times)
+    return results
+
+
+#################################################################################
+###  Results
+#################################################################################
+
+def _flatten(results, prefix=""):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    """Results more than tolerance worse than the baseline (every metric is lower-is-better)"""
+    now, before = _flatten(results["results"]), _flatten(baseline["results"])
+    worse = []
+    for key, value in sorted(now.items()):
+        old = before.get(key)
+        # single worst samples are mostly scheduler noise, don't fail on them
+        if key.endswith(("commands", "swaps", "ticks", ".max")) or not old:
+            continue
+        if value > old * (1 + tolerance):
+            worse.append((key, old, value))
+    return worse
+
+
+def _revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bubbler controller")
+    parser.add_argument("--output", default="bench.json", help="write results as json here")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--ticks", type=int, default=20000)
+    parser.add_argument("--devices", type=int, nargs="+", default=[3, 10, 30])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    with tempfile.TemporaryDirectory(prefix="bubbler-bench-") as workdir:
+        results = {
+            "command": bench_command_latency(_subdir(workdir, "command"), args.commands),
+            "swap": bench_swap(_subdir(workdir, "swap"), args.commands),
+            "tick": bench_tick(_subdir(workdir, "tick"), args.ticks),
+            "sweep_ms": bench_sweep(workdir, args.devices),
+        }
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            worse = regressions(report, json.load(f), args.tolerance)
+        for key, old, new in worse:
+            print(f"REGRESSION {key}: {old} -> {new}")
+        if worse:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
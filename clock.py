@@ -0,0 +1,38 @@
+import time
+
+#####################################################################################
+###  Clocks
+###
+###  everything time related in the controller (timers, dusk/dawn, sample
+###  timestamps) goes through a clock object, so the simulator can swap the
+###  wall clock for a virtual one and replay a winter as fast as the CPU allows
+#####################################################################################
+
+
+class SystemClock:
+    """The real wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        """For measuring intervals, never jumps when NTP sets the time"""
+        return time.monotonic()
+
+
+class VirtualClock:
+    """A clock that only moves when told to"""
+
+    def __init__(self, start):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def set(self, ts):
+        if ts < self.now:
+            raise ValueError("virtual clock can't go backwards")
+        self.now = float(ts)
@@ -0,0 +1,143 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from types import SimpleNamespace
+
+#####################################################################################
+###  Local control socket
+###
+###  commands from the Pi itself (or over ssh) go straight onto the main loop
+###  queue, the same path as an MQTT command, so the master interlock and the
+###  one-bubbler-at-a-time rule apply the same way. The reply is the site
+###  state after the command has run, and the change is still published to
+###  MQTT (or held for reconnect) as usual.
+###
+###  one request per line, json or plain words, one json line back:
+###    {"site": "cust1", "cmd": "bubbler_1", "payload": "ON"}
+###    cust1 bubbler_1 ON
+###    cust1                          status only
+###    cust1 batch {"bubbler_1": "OFF", "bubbler_2": "ON"}
+###
+###  python control.py cust1 bubbler_1 ON
+#####################################################################################
+
+DEFAULT_PATH = "control.sock"
+
+# how long a request waits for the main loop
+TIMEOUT = 5.0
+
+
+class Request:
+    """A command handed to the main loop, with a slot for its reply"""
+
+    def __init__(self, topic=None, payload=""):
+        self.message = SimpleNamespace(topic=topic, payload=payload.encode("utf-8")) if topic else None
+        self.result = None
+        self._done = threading.Event()
+
+    def reply(self, result):
+        self.result = result
+        self._done.set()
+
+    def wait(self, timeout=TIMEOUT):
+        if not self._done.wait(timeout):
+            return {"error": "timed out waiting for the controller"}
+        return self.result
+
+
+def parse(line):
+    """(site, cmd, payload) from a request line, cmd None for a status request"""
+    line = line.strip()
+    if line.startswith("{"):
+        request = json.loads(line)
+        site, cmd, payload = request.get("site"), request.get("cmd"), request.get("payload", "")
+        if not isinstance(site, str):
+            raise ValueError("site must be a string")
+        if cmd is not None and not isinstance(cmd, str):
+            raise ValueError("cmd must be a string")
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)       # a batch given as an object
+        return site, cmd, payload
+    words = line.split(None, 2)         # a batch payload can have spaces
+    if not words:
+        raise ValueError("empty request")
+    return words[0], words[1] if len(words) > 1 else None, words[2] if len(words) > 2 else ""
+
+
+class ControlServer:
+
+    def __init__(self, controller, path=DEFAULT_PATH):
+        self.controller = controller
+        self.path = path
+
+    def handle(self, line):
+        try:
+            name, cmd, payload = parse(line)
+        except ValueError as e:
+            return {"error": f"bad request: {e}"}
+        site = self.controller.sites.get(name)
+        if site is None:
+            return {"error": f"no site {name}"}
+        if cmd is None:
+            request = Request()
+        else:
+            topic = f"{name}/cmd/{cmd}"
+            if topic not in site.commands:
+                return {"error": f"unknown command {cmd}, expected one of "
+                                 + ", ".join(t.rsplit("/", 1)[1] for t in site.commands)}
+            request = Request(topic, payload if cmd == "batch" else payload.upper())
+        self.controller.post(site, "local", request)
+        return request.wait()
+
+    def start(self):
+        """Listen on the socket from a daemon thread"""
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = server.handle(line.decode("utf-8", "replace"))
+                    self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)        # left over from a previous run
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(self.path, 0o660)
+        threading.Thread(target=self._server.serve_forever, name="control", daemon=True).start()
+        logging.info("control socket on %s", self.path)
+        return self
+
+
+def send(path, line, timeout=TIMEOUT + 1):
+    """Send one request line, return the decoded reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(path)
+        s.sendall(line.encode() + b"\n")
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return json.loads(reply)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a command to the local bubbler controller")
+    parser.add_argument("site")
+    parser.add_argument("cmd", nargs="?", help="bubbler_main, auto_bubble, bubbler_1, bubbler_2, danger_lights or batch")
+    parser.add_argument("payload", nargs="?", default="", help="ON or OFF, a json object for batch")
+    parser.add_argument("--socket", default=DEFAULT_PATH)
+    args = parser.parse_args()
+    line = " ".join(x for x in (args.site, args.cmd, args.payload) if x)
+    print(json.dumps(send(args.socket, line), indent=2))
+
+
+if __name__ == "__main__":
+    main()
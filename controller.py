@@ -0,0 +1,884 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from queue import SimpleQueue, Empty
+
+from clock import SystemClock
+from ephemeris import SunTable
+from eventlog import EventLog, TempLog, OUTPUTS, OUTPUT_ON, OUTPUT_OFF
+from filters import SensorFilter
+from history import TempHistory
+import metrics
+from outputs import BACKENDS, MeteredOutput
+from persist import SaveData
+from publisher import Publisher
+from spool import timeseries
+from timers import Scheduler
+import statemachine
+
+#####################################################################################
+###  Bubbler controller for one or many docks in one process
+###
+###  - Site: one dock, with its own state machine, thresholds, savedata file,
+###    temperature history and output backend
+###  - a dock's sensors and outputs are on this box, or for a gateway on the
+###    dock's own Pi: readings come in over MQTT, outputs go through pigpiod
+###  - Controller: the MQTT client, scheduler, event queue and main loop that
+###    all the sites share
+#####################################################################################
+
+# settings for a site, anything can be overridden per site in the config
+SITE_DEFAULTS = {
+    # temps (deg C) for state transistions
+    "temp_to_nightly": 0,
+    "temp_from_nightly": 1,
+    "temp_to_constant": -8,
+    "temp_from_constant": -6,
+
+    # GPIO pins and the backend driving them (outputs.py): "gpiod" writes a
+    # group of outputs at once, "gpio" is gpiozero, "mock" is in memory
+    "pins": {"bubbler_1": 5, "bubbler_2": 6, "bubbler_3": 22, "danger": 26},
+    "backend": "gpio",
+    "gpiochip": None,           # gpiod only, None: /dev/gpiochip0
+    "gpiohost": None,           # gpio only: the Pi of a remote dock, driven through its pigpiod
+
+    # DS18B20 sysfs directory for a sensor bus on this box, "mqtt" for a
+    # remote dock that publishes its readings on <site>/sensors/temperatures
+    # as {"airtemp": .., "watertemp": .., "boxtemp": .., "ts": <epoch read>},
+    # or None if the readings come from elsewhere through Site.record()
+    "sensors": None,
+    # True: read the sensors in a separate process (sensorproc.py), so a slow
+    # 1-Wire read never holds up the main loop. Falls back to a thread if the
+    # process keeps dying.
+    "sensor_process": False,
+    # DS18B20 read intervals (secs): the air sensor is read every `fast` secs
+    # within `margin` deg C of a state machine threshold, any sensor when it
+    # moves `rate` deg C/min or more, otherwise every `slow` secs
+    "polling": {"fast": 2, "slow": 30, "margin": 1.5, "rate": 0.5},
+    # filtering of every reading before it is stored, published or used by
+    # the state machine (filters.py): median of the last `median` readings,
+    # EMA with an `ema` secs time constant (0: off), a failed reading holds
+    # the last value for up to `stale` secs, and the air temp only crosses a
+    # state machine threshold after `dwell` secs on the other side (0: off)
+    "filter": {"median": 5, "ema": 0, "stale": 300, "dwell": 120},
+
+    # {site}, {latitude} and {longitude} in a path are filled in, so every
+    # site gets its own savedata and the sites at one location share a sun table
+    "savefile": "/home/randy/bubbler/savedata-{site}.json",
+    "latitude": 45.08608,
+    "longitude": -79.552073,
+    "suntable": "/home/randy/bubbler/suntable_{latitude}_{longitude}.bin",
+
+    # MQTT publication: temperatures only go out when they move by more than the
+    # deadband (deg C), anything unchanged is still resent after max_silence secs
+    "temp_deadband": {"airtemp": 0.2, "watertemp": 0.2, "boxtemp": 0.5},
+    "max_silence": 300,
+    "combine_states": False,    # True: send bubbler/danger states as one state/outputs message
+
+    # NIGHTLY: [time of day, action] run every day while in the state
+    "nightly": [
+        ["03:00", "bubbler_1_on"],
+        ["04:55", "bubbler_1_off"],
+        ["05:00", "bubbler_2_on"],
+        ["06:55", "bubbler_2_off"],
+    ],
+    # CONSTANT: [action, seconds to the next step], round and round from the
+    # first step for as long as the state lasts. The 3s gaps make sure one
+    # bubbler is off before the other starts, swap_to_bubbler_1/2 instead
+    # switches both in one write.
+    "alternation": [
+        ["bubbler_2_off", 3],
+        ["bubbler_1_on", 60 * 60],
+        ["bubbler_1_off", 3],
+        ["bubbler_2_on", 60 * 60],
+    ],
+
+    # TempHistory sizes, about 1MB a site by default. A gateway with hundreds
+    # of sites can shrink them, e.g. {"raw_capacity": 1800, "minutes": 1440}
+    "history": {},
+
+    # last temperatures go to savedata every temp_save_interval secs, and are
+    # used at startup until the first sweep if not older than temp_max_age
+    "temp_save_interval": 900,
+    "temp_max_age": 1800,
+
+    # path of a binary log of state changes and actuations (eventlog.py), None: off
+    "eventlog": "/home/randy/bubbler/events-{site}.bin",
+    # directory of a columnar log of the temperatures every templog_interval
+    # secs (eventlog.TempLog), None: off. season.py reports on both.
+    "templog": "/home/randy/bubbler/templog-{site}",
+    "templog_interval": 60,
+
+    # outputs the watchdog (watchdog.py) switches to when the main loop stalls:
+    # bubblers off, danger lights on since the ice they kept open is still thin
+    "safe_outputs": {"bubbler_1": 0, "bubbler_2": 0, "danger": 1},
+}
+
+# settings that are paths, see "savefile"
+PATHS = ("savefile", "suntable", "eventlog", "templog")
+# the ones no two sites can share
+OWN_PATHS = ("savefile", "eventlog", "templog")
+
+# sensor index on the bus for each reading
+BOX, WATER, AIR = 0, 1, 2
+
+COMMANDS = ("bubbler_main", "statemachine", "auto_bubble", "bubbler_1", "bubbler_2", "danger_lights", "batch")
+
+# state topic of each output
+OUTPUT_TOPICS = {"bubbler_1": "bubbler_1", "bubbler_2": "bubbler_2", "bubbler_3": "bubbler_3", "danger": "danger_lights"}
+
+# savedata key of each output
+SAVE_KEYS = {"bubbler_1": "b1key", "bubbler_2": "b2key", "bubbler_3": "b3key", "danger": "dangerkey"}
+
+# what a cmd/batch message can set, bubbler_main and auto_bubble first
+BATCH_ORDER = ("bubbler_main", "auto_bubble", "bubbler_1", "bubbler_2", "danger_lights")
+BATCH_OUTPUTS = {topic: key for key, topic in OUTPUT_TOPICS.items() if topic in BATCH_ORDER}
+
+# what the nightly and alternation tables can do
+ACTIONS = ("bubbler_1_on", "bubbler_1_off", "bubbler_2_on", "bubbler_2_off", "swap_to_bubbler_1", "swap_to_bubbler_2")
+
+
+class SiteLog(logging.LoggerAdapter):
+    """Prefix log lines with the site name"""
+
+    def process(self, msg, kwargs):
+        return f"{self.extra['site']}: {msg}", kwargs
+
+
+class Site:
+
+    def __init__(self, controller, name, **settings):
+        unknown = set(settings) - set(SITE_DEFAULTS)
+        if unknown:
+            raise ValueError(f"unknown settings for site {name}: {', '.join(sorted(unknown))}")
+        config = dict(SITE_DEFAULTS, **settings)
+        for key in PATHS:
+            if config[key]:
+                config[key] = config[key].format(site=name, latitude=config["latitude"], longitude=config["longitude"])
+        # two sites on one savefile would load and overwrite each other's state,
+        # on one event or temperature log they'd mix their records
+        for other in controller.sites.values():
+            for key in OWN_PATHS:
+                mine, theirs = config[key], other.paths[key]
+                if mine and theirs and os.path.abspath(mine) == os.path.abspath(theirs):
+                    raise ValueError(f"site {name}: {key} {mine} is already used by site {other.name}")
+        self.paths = {key: config[key] for key in PATHS}
+
+        self.controller = controller
+        self.name = name
+        self.scheduler = controller.scheduler
+        self.clock = controller.clock
+        self.nightly_tag = f"{name}/nightly"
+        self.constant_tag = f"{name}/constant"
+        self.log = SiteLog(logging.getLogger(__name__), {"site": name})
+
+        self.temp_to_nightly = config["temp_to_nightly"]
+        self.temp_from_nightly = config["temp_from_nightly"]
+        self.temp_to_constant = config["temp_to_constant"]
+        self.temp_from_constant = config["temp_from_constant"]
+        self.temp_deadband = config["temp_deadband"]
+        self.safe_outputs = config["safe_outputs"]
+
+        # initialize outputs
+        if config["gpiohost"] and config["backend"] not in ("gpio", "gpiozero"):
+            raise ValueError(f"site {name}: gpiohost needs the gpio backend, not {config['backend']}")
+        self.outputs = BACKENDS[config["backend"]](config["pins"], chip=config["gpiochip"], host=config["gpiohost"],
+                                                   site=name)
+        self.events = EventLog(config["eventlog"]) if config["eventlog"] else None
+        self.temps = TempLog(config["templog"]) if config["templog"] else None
+
+        def output(key):
+            index = OUTPUTS.index(key)
+            def changed(on):
+                self.log_event(OUTPUT_ON if on else OUTPUT_OFF, index)
+            return MeteredOutput(self.outputs.output(key), self.clock, on_change=changed, site=name, output=key)
+        self.bubbler_1 = output("bubbler_1")
+        self.bubbler_2 = output("bubbler_2")
+        self.bubbler_3 = output("bubbler_3")
+        self.danger = output("danger")
+
+        # initialize variables
+        self.state = statemachine.OFF
+        self.dl_flag = 0            # flag for danger lights
+
+        # timed actuations, checked here so a typo in a site config fails at start
+        self.nightly = [(at, self._action(action)) for at, action in config["nightly"]]
+        self.alternation = [(self._action(action), float(wait)) for action, wait in config["alternation"]]
+        if not self.alternation or sum(wait for _, wait in self.alternation) <= 0:
+            raise ValueError(f"site {name}: alternation needs at least one step and some time between steps")
+
+        # MQTT command topic -> handler
+        self.commands = {
+            f"{name}/cmd/bubbler_main": self.cmd_bubbler_main,
+            f"{name}/cmd/auto_bubble": self.cmd_auto_bubble,
+            f"{name}/cmd/bubbler_1": self.cmd_bubbler_1,
+            f"{name}/cmd/bubbler_2": self.cmd_bubbler_2,
+            f"{name}/cmd/danger_lights": self.cmd_danger_lights,
+            f"{name}/cmd/batch": self.cmd_batch,
+        }
+        self._in_batch = False      # savedata once at the end of a batch
+
+        # temperature history (raw samples plus 1m/1h/1d rollups), written after
+        # every sensor sweep. The state machine and telemetry read from here.
+        self.history = TempHistory(**config["history"])
+        self.thresholds = (self.temp_to_nightly, self.temp_from_nightly, self.temp_to_constant, self.temp_from_constant)
+        self.filters = {
+            "air": SensorFilter(thresholds=self.thresholds, **config["filter"], site=name, reading="air"),
+            "water": SensorFilter(**dict(config["filter"], dwell=0), site=name, reading="water"),
+            "box": SensorFilter(**dict(config["filter"], dwell=0), site=name, reading="box"),
+        }
+        self.air_temp_loop = None
+        self.sensor = None
+        self.sensor_dir = config["sensors"]
+        self.readings_topic = f"{name}/sensors/temperatures" if self.sensor_dir == "mqtt" else None
+        self.temps_topic = f"{name}/state/temperatures"
+        self.polling = config["polling"]
+        self.sensor_process = config["sensor_process"]
+
+        self.pub = Publisher(controller.client, name, max_silence=config["max_silence"],
+                             combine=config["combine_states"], monotonic=self.clock.monotonic,
+                             spool=controller.spool, wall=self.clock.time)
+        self.pub.online = controller.connected is not False
+        self.sun = controller.sun_table(config["suntable"], config["latitude"], config["longitude"])
+
+        # load values of power on/off and autobubble from persistent savedata.json file
+        self.store = SaveData(config["savefile"], monotonic=self.clock.monotonic)
+        data = self.store.load()
+        self.master = data["mainkey"]
+        self.auto_bubble = data["autokey"]
+        self.log.debug("loading from initial load of savedata file")
+        self.log.debug("main power = %s", self.master)
+        self.log.debug("auto_bubble = %s", self.auto_bubble)
+        # outputs switched by hand come back as they were, with auto_bubble on
+        # the state machine switches them itself. The state isn't restored, it
+        # follows from bubbler_main, auto_bubble and the temperatures.
+        if self.master == 1 and self.auto_bubble == 0:
+            restore = {key: data[SAVE_KEYS[key]] for key in OUTPUT_TOPICS if data[SAVE_KEYS[key]]}
+            if restore.get("bubbler_1") and restore.get("bubbler_2"):
+                del restore["bubbler_2"]        # only one bubbler at a time
+            if restore:
+                self.log.debug("restoring outputs %s", ", ".join(restore))
+                self.set_outputs(restore)
+
+        # carry on with the last temperatures until the sensors have been read,
+        # so a NIGHTLY or CONSTANT dock goes straight back to it after a power blip
+        age = self.clock.time() - data["tempts"]
+        if data["airtemp"] is not None and 0 <= age <= config["temp_max_age"]:
+            self.history.append(data["tempts"], data["airtemp"], data["watertemp"], data["boxtemp"])
+            self.log.debug("restored temperatures from %d s ago, air %s", age, data["airtemp"])
+        self.scheduler.every(config["temp_save_interval"], self.save_temps)
+        if self.temps is not None:
+            self.scheduler.every(config["templog_interval"], self.log_temps)
+
+    def topics(self):
+        topics = [(f"{self.name}/cmd/{cmd}", 1) for cmd in COMMANDS]
+        if self.readings_topic:
+            topics.append((self.readings_topic, 0))
+        return topics
+
+    ################################################################################
+    ###  Temperatures
+    ################################################################################
+
+    def start_sensors(self):
+        """Start a DS18B20 reader if this site has a sensor bus on this box"""
+        if self.sensor_dir is None or self.sensor_dir == "mqtt":
+            return
+        from ds18b20 import DS18B20, PollPolicy
+        policies = {
+            AIR: PollPolicy(thresholds=self.thresholds, **self.polling),
+            WATER: PollPolicy(**self.polling),
+            BOX: PollPolicy(**self.polling),
+        }
+        if self.sensor_process:
+            from sensorproc import SensorProcess
+            self.sensor = SensorProcess(self.sensor_dir, on_sweep=self.sweep_done, policies=policies)
+        else:
+            self.sensor = DS18B20(self.sensor_dir, on_sweep=self.sweep_done, policies=policies)
+        self.sensor.start()
+
+    def sweep_done(self):
+        # a sweep only reads the sensors that are due, the others hand in their last reading again
+        d = self.sensor
+        self.record(self.clock.time(), d.tempC(AIR), d.tempC(WATER), d.tempC(BOX),
+                    read_at=(d.read_at(AIR), d.read_at(WATER), d.read_at(BOX)))
+
+    def record(self, ts, air, water, box, read_at=(None, None, None)):
+        """Filter and add a reading, wake the main loop only when the air temp actually changed.
+
+        read_at: when the sensors read each value, if known (see SensorFilter.add)
+        """
+        air_at, water_at, box_at = read_at
+        filters = self.filters
+        last_air_temp = filters["air"].value
+        air = filters["air"].add(ts, air, air_at)
+        self.history.append(ts, air, filters["water"].add(ts, water, water_at), filters["box"].add(ts, box, box_at))
+        if air != last_air_temp:
+            self.controller.post(self, "temp")
+
+    def remote_reading(self, payload):
+        """A reading published by a remote dock, see "sensors" """
+        try:
+            values = json.loads(payload)
+            read_at = values.get("ts")
+            if read_at is not None:
+                read_at = float(read_at)
+        except (ValueError, TypeError, AttributeError) as e:
+            self.log.warning("bad reading %r: %s", payload[:100], e)
+            return
+        def temp(key):
+            value = values.get(key)
+            return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        self.record(self.clock.time(), temp("airtemp"), temp("watertemp"), temp("boxtemp"),
+                    read_at=(read_at, read_at, read_at))
+
+    def save_temps(self):
+        air, water, box = self.history.latest_sample()
+        if air is not None:
+            self.store.update(airtemp=air, watertemp=water, boxtemp=box, tempts=self.clock.time())
+
+    def log_temps(self):
+        self.temps.append(self.clock.time(), *self.history.latest_sample())
+
+    def publish_temp(self):
+        air, water, box = self.history.latest_sample()
+        send_temp = {'airtemp': air, 'watertemp': water, 'boxtemp': box}
+        self.pub.publish_readings(self.temps_topic, send_temp, self.temp_deadband)
+
+    ################################################################################
+    ###  Function to update savedata.json file every time value changes
+    ###   - cheap: only hands the values to the store, which batches the
+    ###     changes and writes them off the control path
+    ################################################################################
+
+    def log_event(self, kind, value):
+        if self.events is not None:
+            self.events.append(self.clock.time(), kind, value, self.air_temp_loop)
+
+    def savedata(self):
+        if self._in_batch:
+            return
+        self.store.update(mainkey=self.master, statekey=self.state, autokey=self.auto_bubble, b1key=self.bubbler_1.value, b2key=self.bubbler_2.value, b3key=self.bubbler_3.value, dangerkey=self.danger.value)
+
+    ################################################################################
+    ###  Functions to turn bubblers and danger lights on/off
+    ###   - only allow 1 bubbler to run at a time
+    ################################################################################
+
+    def bubbler_1_off(self):
+        self.bubbler_1.off()
+        self.pub.state("bubbler_1", "OFF")
+        self.savedata()
+
+    def bubbler_1_on(self):
+        if self.bubbler_2.value == 0:
+            self.bubbler_1.on()
+            self.pub.state("bubbler_1", "ON")
+            self.savedata()
+
+    def bubbler_2_off(self):
+        self.bubbler_2.off()
+        self.pub.state("bubbler_2", "OFF")
+        self.savedata()
+
+    def bubbler_2_on(self):
+        if self.bubbler_1.value == 0:
+            self.bubbler_2.on()
+            self.pub.state("bubbler_2", "ON")
+            self.savedata()
+
+    def swap_to_bubbler_1(self):
+        self.set_outputs({"bubbler_2": 0, "bubbler_1": 1})
+
+    def swap_to_bubbler_2(self):
+        self.set_outputs({"bubbler_1": 0, "bubbler_2": 1})
+
+    def set_outputs(self, values):
+        """Switch several outputs with one write, e.g. {"bubbler_1": 0, "bubbler_2": 1}.
+
+        The caller has checked the interlocks.
+        """
+        outputs = {key: getattr(self, key) for key in values}
+        before = {key: output.value for key, output in outputs.items()}
+        self.outputs.set(values)
+        for key, output in outputs.items():
+            output.changed(before[key], values[key])
+            self.pub.state(OUTPUT_TOPICS[key], "ON" if values[key] else "OFF")
+        self.savedata()
+
+    def go_safe(self):
+        """Straight to the safe outputs, from the watchdog while the main loop is stuck.
+
+        The metering, published states and savedata catch up when the main
+        loop gets to the "safe" event, if it ever does.
+        """
+        try:
+            before = self.outputs.set(self.safe_outputs)
+        except Exception:
+            self.log.exception("could not set the safe outputs")
+            return
+        self.log.critical("outputs set to the safe state %s", self.safe_outputs)
+        self.controller.post(self, "safe", before)
+
+    def went_safe(self, before):
+        """Account for the outputs go_safe() switched behind the main loop's back"""
+        for key, was in before.items():
+            output = getattr(self, key)
+            output.changed(was, output.value)
+            self.pub.state(OUTPUT_TOPICS[key], "ON" if output.value else "OFF")
+        self.savedata()
+        # the lights as if check_danger_lights() had switched them: back off by
+        # day, and off at dawn if they're on at night
+        self.dl_flag = self.danger.value
+        self.check_danger_lights()
+
+    def danger_lights_off(self):
+        self.danger.off()
+        self.pub.state("danger_lights", "OFF")
+        self.savedata()
+
+    def danger_lights_on(self):
+        self.danger.on()
+        self.pub.state("danger_lights", "ON")
+        self.savedata()
+
+    def status(self):
+        """What the control socket replies with"""
+        def onoff(flag):
+            return "ON" if flag else "OFF"
+        return {
+            "site": self.name,
+            "state": statemachine.STATE_NAMES[self.state],
+            "bubbler_main": onoff(self.master),
+            "auto_bubble": onoff(self.auto_bubble),
+            "bubbler_1": onoff(self.bubbler_1.value),
+            "bubbler_2": onoff(self.bubbler_2.value),
+            "danger_lights": onoff(self.danger.value),
+            "air_temp": self.air_temp_loop,
+            "broker": self.pub.online,
+        }
+
+    ################################################################################
+    ###  Handle one MQTT command message
+    ################################################################################
+
+    def handle_message(self, msg):
+        topic = str(msg.topic)
+        payload = str(msg.payload.decode("utf-8"))
+        self.log.debug("mqtt %s %s", topic, payload)
+        handler = self.commands.get(topic)
+        if handler is None:
+            self.log.debug("no handler for %s", topic)
+            return
+        handler(payload)
+        self.savedata()
+
+    def cmd_bubbler_main(self, payload):
+        if payload == "ON":
+            self.pub.publish(f"{self.name}/state/bubbler_main","ON", qos=1, retain=True)
+            self.master = 1
+        else:
+            self.pub.publish(f"{self.name}/state/bubbler_main","OFF",1,True)
+            self.master = 0
+            self.bubbler_1_off()
+            self.bubbler_2_off()
+            self.danger_lights_off()
+
+    def cmd_auto_bubble(self, payload):
+        if payload == "ON":
+            if self.master == 1:  ### only turn on auto_bubble if master power is on
+                self.pub.publish(f"{self.name}/state/auto_bubble","ON", qos=1, retain=True)
+                self.auto_bubble = 1
+                self.bubbler_1_off()
+                self.bubbler_2_off()
+                self.danger_lights_off()
+        else:
+            self.pub.publish(f"{self.name}/state/auto_bubble","OFF", qos=1, retain=True)
+            self.auto_bubble = 0
+
+    def cmd_bubbler_1(self, payload):
+#        if auto_bubble == 0:  ### only turn on/off if auto bubble not enabled
+        if payload == "ON":
+            if self.master == 1:
+                self.bubbler_1_on()
+        else:
+            self.bubbler_1_off()
+
+    def cmd_bubbler_2(self, payload):
+        if payload == "ON":
+            if self.master == 1:
+                self.bubbler_2_on()
+        else:
+            self.bubbler_2_off()
+
+    def cmd_danger_lights(self, payload):
+        if payload == "ON":
+            if self.master == 1:
+                self.danger_lights_on()
+        else:
+            self.danger_lights_off()
+
+    def cmd_batch(self, payload):
+        """Several commands as one json object, e.g. {"bubbler_1": "OFF", "bubbler_2": "ON"}.
+
+        The whole batch is checked against the interlocks first and refused if
+        any part of it would be, then the outputs are all switched in one write.
+        On the gpiod backend a swap of bubblers never has both (or neither)
+        running, the others write pin by pin, offs first, so never both.
+        Each changed state is published once and savedata written once.
+        """
+        try:
+            commands = self._check_batch(payload)
+        except ValueError as e:
+            self.log.warning("batch refused: %s", e)
+            self.pub.publish(f"{self.name}/state/batch", json.dumps({"ok": False, "error": str(e)}), 1, force=True)
+            return
+        self.pub.hold()
+        self._in_batch = True
+        try:
+            # bubbler_main and auto_bubble first, then every output in one write
+            for key in BATCH_ORDER[:2]:
+                if key in commands:
+                    self.commands[f"{self.name}/cmd/{key}"](commands[key])
+            self.set_outputs({BATCH_OUTPUTS[key]: commands[key] == "ON" for key in BATCH_ORDER[2:] if key in commands})
+        finally:
+            self._in_batch = False
+            self.pub.release()
+        self.savedata()
+        # a reply to every batch, the same as the last one too
+        self.pub.publish(f"{self.name}/state/batch", json.dumps({"ok": True}), 1, force=True)
+
+    def _check_batch(self, payload):
+        """The commands of a batch, ValueError if it can't be applied as a whole"""
+        try:
+            commands = json.loads(payload)
+        except ValueError:
+            raise ValueError("not json")
+        if not isinstance(commands, dict) or not commands:
+            raise ValueError("expected a json object of command: ON/OFF")
+        unknown = set(commands) - set(BATCH_ORDER)
+        if unknown:
+            raise ValueError(f"unknown commands {', '.join(sorted(unknown))}")
+        commands = {key: str(value).upper() for key, value in commands.items()}
+        bad = [key for key, value in commands.items() if value not in ("ON", "OFF")]
+        if bad:
+            raise ValueError(f"{', '.join(bad)} must be ON or OFF")
+
+        master = commands.get("bubbler_main", "ON" if self.master == 1 else "OFF") == "ON"
+        turning_on = [key for key in BATCH_ORDER[2:] if commands.get(key) == "ON"]
+        if not master and (turning_on or commands.get("auto_bubble") == "ON"):
+            raise ValueError(f"bubbler_main is off, can't turn on {', '.join(turning_on) or 'auto_bubble'}")
+        if commands.get("auto_bubble") == "ON" and turning_on:
+            raise ValueError(f"auto_bubble turns the outputs off, can't also turn on {', '.join(turning_on)}")
+        # what the bubblers are at the end, anything not in the batch stays as it is
+        b1 = commands.get("bubbler_1", "ON" if self.bubbler_1.value else "OFF") == "ON"
+        b2 = commands.get("bubbler_2", "ON" if self.bubbler_2.value else "OFF") == "ON"
+        if b1 and b2 and ("bubbler_1" in turning_on or "bubbler_2" in turning_on):
+            raise ValueError("only one bubbler can run at a time")
+        return commands
+
+    ################################################################################
+    ###  Operate Danger Lights from Dusk to Dawn unless state = 0
+    ################################################################################
+
+    def check_danger_lights(self):
+        now = self.clock.time()
+        today_now = time.strftime("%H:%M", time.localtime(now))
+
+        if self.sun.is_dark(now):
+            if self.dl_flag == 0:
+                if self.master == 1:
+                    self.danger_lights_on()
+                    self.log.debug("danger lights on at: %s", today_now)
+                    self.dl_flag = 1
+        else:
+            if self.dl_flag == 1:
+                self.danger_lights_off()
+                self.log.debug("danger lights off at: %s", today_now)
+                self.dl_flag = 0
+
+    ################################################################################
+    ###  Timed actuations of the NIGHTLY and CONSTANT states, started and
+    ###  stopped by the state machine (statemachine.py)
+    ################################################################################
+
+    def _action(self, name):
+        if name not in ACTIONS:
+            raise ValueError(f"site {self.name}: unknown action {name}, expected one of {', '.join(ACTIONS)}")
+        return getattr(self, name)
+
+    def start_nightly(self):
+        for at, action in self.nightly:
+            self.scheduler.daily(at, action, tag=self.nightly_tag)
+        self.log.debug("setting nightly schedule: %s", ", ".join(at for at, _ in self.nightly))
+
+    def stop_nightly(self):
+        self.scheduler.cancel(self.nightly_tag)
+        self.log.debug("clearing nightly schedule")
+
+    def start_constant(self):
+        # the timers replace the old Alternator thread, leaving the state
+        # cancels the pending step at once
+        self.scheduler.cycle(self.alternation, tag=self.constant_tag)
+        self.log.debug("alternating bubblers")
+
+    def stop_constant(self):
+        self.scheduler.cancel(self.constant_tag)
+
+
+#################################################################################
+###  Controller shared by all the sites
+#################################################################################
+
+class Controller:
+
+    def __init__(self, client, name, clock=None):
+        self.client = client
+        self.name = name        # gateway name, the MQTT client id
+        self.clock = clock if clock else SystemClock()
+        self.scheduler = Scheduler(self.clock)
+        self.sites = {}
+
+        # event queue for the main loop: (site, "mqtt", message) from on_message,
+        # (site, "local", request) from the control socket, (site, "temp", None)
+        # when a site's air reading changes and (site, "safe", outputs before)
+        # after the watchdog set the safe outputs
+        self.q = SimpleQueue()
+
+        self._routes = {}       # command topic -> site
+        self._sun_tables = {}
+        self._sun_due = []      # heap of (time, site name) of each site's next dusk/dawn
+
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        client.on_disconnect = self.on_disconnect
+        client.on_connect_fail = self.on_connect_fail
+
+        self.connected = None   # unknown until the first connect or failure
+        self.ticks = 0          # main loop passes
+        self.spool = None
+        self.spool_batch = 100
+
+        # one job publishes the temperatures of every site
+        self.scheduler.every(10, self.publish_temps)
+        # event logs go to the card once a minute
+        self.scheduler.every(60, self.flush_events)
+
+        self._tick_time = {kind: metrics.histogram("bubbler_tick_seconds", "main loop time per event", kind=kind)
+                           for kind in ("mqtt", "local", "safe", "temp", "timers")}
+        metrics.gauge("bubbler_queue_depth", "events waiting for the main loop", fn=self.q.qsize)
+
+    def add_site(self, name, **settings):
+        if "/" in name or name in self.sites:
+            raise ValueError(f"bad or duplicate site name: {name}")
+        site = Site(self, name, **settings)
+        self.sites[name] = site
+        for topic, qos in site.topics():
+            self._routes[topic] = site
+        return site
+
+    def sun_table(self, path, latitude, longitude):
+        """Sites at the same dock location share one table"""
+        key = (path, latitude, longitude)
+        if key not in self._sun_tables:
+            self._sun_tables[key] = SunTable.load(path, latitude, longitude)
+        return self._sun_tables[key]
+
+    def post(self, site, kind, payload=None):
+        self.q.put((site, kind, payload))
+
+    ######################################################################################
+    ###  MQTT callbacks, one connection for every site
+    ######################################################################################
+
+    def set_online(self, online):
+        if online != self.connected:
+            logging.info("broker %s", "connected" if online else "unreachable, holding telemetry")
+        self.connected = online
+        for site in self.sites.values():
+            site.pub.online = online
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.set_online(False)
+
+    def on_connect_fail(self, client, userdata):
+        self.set_online(False)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if getattr(reason_code, "is_failure", False):
+            self.set_online(False)
+            return
+        self.set_online(True)
+        # availability is the gateway's, the topic of the connection's will: a
+        # site's own topic would stay "online" after a crash
+        client.publish(f"{self.name}/state/availability", "online", qos=1, retain=True)
+        topics = []
+        for site in self.sites.values():
+            if site.name != self.name:
+                # drop the retained "online" earlier versions left on the site's topic
+                client.publish(f"{site.name}/state/availability", None, qos=1, retain=True)
+            site.pub.republish()     # in case the broker lost its retained state
+            topics.extend(site.topics())
+        client.subscribe(topics)
+
+    def on_message(self, client, userdata, message):
+        site = self._routes.get(message.topic)
+        if site is None:
+            return
+        if message.topic == site.readings_topic:
+            # filtered here on the network thread, the same as a sweep on the sensor thread
+            site.remote_reading(message.payload)
+        else:
+            self.post(site, "mqtt", message)
+
+    def publish_temps(self):
+        for site in self.sites.values():
+            site.publish_temp()
+
+    def flush_events(self):
+        for site in self.sites.values():
+            if site.events is not None:
+                site.events.flush()
+            if site.temps is not None:
+                site.temps.flush()
+
+    def watched_by(self, watchdog, limit=60, sensor_limit=300, write_limit=30):
+        """Register the main loop and every site's sensors and savedata writes with a watchdog"""
+        watchdog.watch("main loop", lambda: self.ticks, limit, fatal=True)
+        for site in self.sites.values():
+            watchdog.watch(f"{site.name} savedata", lambda store=site.store: store.writing, write_limit, fatal=True)
+            if site.sensor is not None:
+                thread = site.sensor if isinstance(site.sensor, threading.Thread) else None
+                watchdog.watch(f"{site.name} sensors", lambda sensor=site.sensor: sensor.sweeps, sensor_limit,
+                               thread=thread)
+
+    def safe_state(self, stalled=None):
+        for site in self.sites.values():
+            site.go_safe()
+
+    def use_spool(self, spool, batch=100, interval=1.0):
+        """Keep readings in spool while offline, send them back batch records every interval secs"""
+        self.spool = spool
+        self.spool_batch = batch
+        for site in self.sites.values():
+            site.pub.spool = spool
+        self.scheduler.every(interval, self.drain_spool)
+        self.scheduler.every(60, spool.flush)
+
+    def drain_spool(self):
+        if not self.connected or not len(self.spool):
+            return
+        records, end = self.spool.peek(self.spool_batch)
+        for topic, payload in timeseries(records):
+            info = self.client.publish(topic, payload, qos=1)
+            if getattr(info, "rc", 0):
+                return      # went away again, the batch stays for next time
+        self.spool.commit(end)
+
+    def publish_metrics(self):
+        self.client.publish(f"{self.name}/state/metrics", json.dumps(metrics.REGISTRY.snapshot()), qos=0)
+
+    def publish_metrics_every(self, seconds):
+        """Also send the metrics as json on <gateway>/state/metrics"""
+        self.scheduler.every(seconds, self.publish_metrics)
+
+    #################################################################################
+    ### Main Loop
+    ###   - sleep until the next event: an MQTT message, a changed air temp,
+    ###     the next schedule job or the next dusk/dawn boundary of any site
+    ###   - then run only the logic that event affects, for that site only
+    #################################################################################
+
+    def _sun_event(self, site):
+        now = self.clock.time()
+        heapq.heappush(self._sun_due, (now + site.sun.seconds_to_next(now), site.name))
+        site.check_danger_lights()
+
+    def start(self):
+        for site in self.sites.values():
+            site.air_temp_loop = site.history.latest("air")
+            self._sun_event(site)
+            statemachine.step(site)
+            site.pub.flush()
+
+    def dispatch(self, site, kind, payload):
+        if kind == "mqtt":
+            site.handle_message(payload)
+            site.check_danger_lights()
+            statemachine.step(site, "cmd")
+        elif kind == "local":
+            # control socket, same path as an MQTT command, no message is a status request
+            if payload.message is not None:
+                site.handle_message(payload.message)
+                site.check_danger_lights()
+                statemachine.step(site, "cmd")
+        elif kind == "safe":
+            site.went_safe(payload)
+        elif kind == "temp":
+            site.air_temp_loop = site.history.latest("air")
+#            site.log.debug("new air_temp_loop: %s", site.air_temp_loop)
+            statemachine.step(site, "temp")
+
+        site.pub.flush()
+        if kind == "local":
+            payload.reply(site.status())
+
+    def run_timers(self):
+        try:
+            self.scheduler.run_pending()
+        except Exception:
+            # the timer that failed is already rescheduled or dropped, any
+            # others that are due run on the next pass
+            logging.exception("error in timer")
+        now = self.clock.time()
+        while self._sun_due and self._sun_due[0][0] <= now:
+            _, name = heapq.heappop(self._sun_due)
+            site = self.sites[name]
+            try:
+                self._sun_event(site)
+            except Exception:
+                site.log.exception("error handling dusk/dawn")
+        for site in self.sites.values():
+            site.pub.flush()
+
+    def next_due(self):
+        """Epoch time of the next timer or dusk/dawn boundary, None if nothing is pending"""
+        due = self.scheduler.next_due()
+        if self._sun_due and (due is None or self._sun_due[0][0] < due):
+            due = self._sun_due[0][0]
+        return due
+
+    def timeout(self):
+        """Seconds until the next timer or dusk/dawn boundary"""
+        due = self.next_due()
+        return None if due is None else max(due - self.clock.time(), 0)
+
+    def handle(self, site, kind, payload):
+        start = time.perf_counter()
+        try:
+            self.dispatch(site, kind, payload)
+        except Exception:
+            # one broken site must not stop the others
+            site.log.exception("error handling %s event", kind)
+            if kind == "local":
+                payload.reply({"error": "command failed, see the log"})
+        self._tick_time[kind].observe(time.perf_counter() - start)
+
+    def run(self):
+        self.start()
+        while True:
+            self.ticks += 1     # the watchdog's sign of life, the loop wakes at least every 10s
+            try:
+                self.handle(*self.q.get(timeout=self.timeout()))
+            except Empty:
+                pass
+            # whenever they're due, not only when the queue is empty: a steady
+            # stream of events must not hold off the timers and dusk/dawn
+            due = self.next_due()
+            if due is not None and due <= self.clock.time():
+                start = time.perf_counter()
+                self.run_timers()
+                self._tick_time["timers"].observe(time.perf_counter() - start)
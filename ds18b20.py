@@ -0,0 +1,280 @@
+import glob
+import logging
+import threading
+import os
+import time
+
+import metrics
+
+##################################################################################################
+### create a seperate thread to read the DS18B20 temp sensors
+###
+### from https://stackoverflow.com/questions/72771186/read-multiple-ds18b20-temperature-sensors-faster-using-raspberry-pi
+###
+###  - each w1_slave is opened once and re-read with pread at offset 0, which
+###    makes the kernel run a new conversion, no open/close per read
+###  - the scratchpad bytes are checked with the DS18B20's own CRC8 and the
+###    temperature is taken from them, not from the "t=" text
+###  - every sensor has a PollPolicy: read often near a state machine
+###    threshold or when the reading moves fast, seldom when it is stable
+###  - discover() runs again every `rediscover` secs, a new sensor gets the
+###    next index and an unplugged one keeps its index with no reading
+##################################################################################################
+
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8C if crc & 1 else crc >> 1
+        table.append(crc)
+    return bytes(table)
+
+CRC8_TABLE = _crc8_table()
+
+def crc8(data):
+    """Dallas/Maxim 1-Wire CRC8 (x^8 + x^5 + x^4 + 1)"""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def parse_w1_slave(data):
+    """Temperature (deg C) from the bytes of a w1_slave read, None if the read is bad.
+
+    The first line is the 9 byte scratchpad in hex, the kernel's crc and YES/NO.
+    """
+    try:
+        scratchpad = bytes.fromhex(data[:26].decode("ascii"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if len(scratchpad) != 9 or not any(scratchpad) or crc8(scratchpad[:8]) != scratchpad[8]:
+        return None
+    raw = int.from_bytes(scratchpad[:2], "little", signed=True)
+    if raw == 0x0550 and scratchpad[6] == 0x0C:
+        return None     # 85.0 power-on value, the conversion never ran
+    return raw / 16.0
+
+
+def w1_slave_text(temp):
+    """What the kernel shows in w1_slave for a DS18B20 reading temp, for fake sysfs trees"""
+    raw = round(temp * 16)
+    scratchpad = raw.to_bytes(2, "little", signed=True) + bytes([0x4B, 0x46, 0x7F, 0xFF, 0x0C, 0x10])
+    scratchpad += bytes([crc8(scratchpad)])
+    hex_bytes = " ".join(f"{b:02x}" for b in scratchpad)
+    return f"{hex_bytes} : crc={scratchpad[8]:02x} YES\n{hex_bytes} t={round(raw * 62.5)}\n"
+
+
+class PollPolicy:
+    """How often to read one sensor"""
+
+    def __init__(self, fast=2.0, slow=2.0, thresholds=(), margin=1.0, rate=0.5):
+        self.fast = fast                # secs, near a threshold, moving fast, or no reading
+        self.slow = slow                # secs, otherwise
+        self.thresholds = tuple(thresholds)
+        self.margin = margin            # deg C either side of a threshold
+        self.rate = rate                # deg C per minute that counts as moving fast
+
+    def interval(self, value, rate):
+        if value is None or abs(rate) >= self.rate:
+            return self.fast
+        for threshold in self.thresholds:
+            if abs(value - threshold) <= self.margin:
+                return self.fast
+        return self.slow
+
+
+class _Sensor:
+    """One DS18B20 on the bus"""
+
+    def __init__(self, folder, policy):
+        self.id = os.path.basename(folder)
+        self.path = os.path.join(folder, "w1_slave")
+        self.policy = policy
+        self.fd = None
+        self.value = None
+        self.time = 0.0                 # wall clock time of the last good read
+        self.read_at = None             # monotonic time of the last good read
+        self.rate = 0.0                 # deg C per minute over the last two reads
+        self.due = 0.0                  # monotonic time of the next read
+        self.read_time = metrics.histogram("bubbler_sensor_read_seconds", "DS18B20 w1_slave read time",
+                                           sensor=self.id)
+        self.retries = metrics.counter("bubbler_sensor_retries_total", "DS18B20 reads with a bad CRC",
+                                       sensor=self.id)
+        self.failures = metrics.counter("bubbler_sensor_failures_total", "DS18B20 reads that failed 3 times",
+                                        sensor=self.id)
+
+    def read(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        return os.pread(self.fd, 128, 0)
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+class DS18B20(threading.Thread):
+
+    default_base_dir = "/sys/bus/w1/devices/"
+
+    # therm_bulk_read reports -1 while a conversion is in progress, 1 once
+    # results are ready. 12 bit conversion is 750ms, allow some slack.
+    bulk_timeout = 1.5
+
+    # look for added or removed sensors this often (secs)
+    rediscover = 60
+
+    def __init__(self, base_dir=None, on_sweep=None, bulk=True, policies=None):
+        super().__init__()
+        self._base_dir = base_dir if base_dir else self.default_base_dir
+        self._on_sweep = on_sweep   # called after every pass that read a sensor
+        self._bulk = bulk           # convert all sensors at once when the master supports it
+        self._policies = policies or {}     # sensor index -> PollPolicy
+        self._sensors: list[_Sensor] = []
+        self.daemon = True
+        self.ready = threading.Event()  # set after the first full sweep
+        self.sweeps = 0                 # for the watchdog
+        self.discover()
+
+    def discover(self):
+        """Pick up new sensors, existing ones keep their index"""
+        known = {s.id for s in self._sensors}
+        for folder in glob.glob(self._base_dir + "28*"):
+            if os.path.basename(folder) not in known:
+                index = len(self._sensors)
+                self._sensors.append(_Sensor(folder, self._policies.get(index, PollPolicy())))
+                if self.ready.is_set():
+                    logging.info("new temperature sensor %s at index %d", self._sensors[-1].id, index)
+        self._num_devices = len(self._sensors)
+
+        # one therm_bulk_read file per bus master (w1_bus_master1, ...)
+        self._bulk_file: list[str] = glob.glob(self._base_dir + "w1_bus_master*/therm_bulk_read")
+
+    def run(self):
+        """Thread entrypoint: read sensors in a loop.
+
+        Calling DS18B20.start() will cause this method to run in
+        a separate thread.
+        """
+
+        self.sweep()
+        next_discover = time.monotonic() + self.rediscover
+        while True:
+            now = time.monotonic()
+            if now >= next_discover:
+                self.discover()
+                next_discover = now + self.rediscover
+            due = [i for i, s in enumerate(self._sensors) if s.due <= now]
+            if due:
+                self.sweep(due)
+            # sleep until the next sensor is due. Without a bulk read a read
+            # takes 750ms, so a fast policy below that is just back to back reads.
+            wake = min([s.due for s in self._sensors] + [next_discover])
+            time.sleep(max(wake - time.monotonic(), 0.05))
+
+    def sweep(self, devices=None):
+        """Read the given sensors (default all) once"""
+        if devices is None:
+            devices = range(self._num_devices)
+        if self._bulk and self._bulk_file:
+            if not self._bulk_convert():
+                logging.debug("bulk conversion failed, reading sensors one at a time")
+
+        for dev in devices:
+            self._read_temp(dev)
+
+        if self._on_sweep:
+            self._on_sweep()
+        self.sweeps += 1
+        self.ready.set()
+
+    def _bulk_convert(self):
+        """Start one conversion on every sensor of every bus master and wait for it.
+
+        After a bulk conversion, reading w1_slave returns the converted value
+        without starting a new conversion, so the sweep doesn't block 750ms per
+        sensor. Returns False if the masters can't do it, in which case the
+        sequential reads in run() still work, just slower.
+        """
+        try:
+            for path in self._bulk_file:
+                with open(path, "w") as f:
+                    f.write("trigger\n")
+
+            deadline = time.monotonic() + self.bulk_timeout
+            pending = list(self._bulk_file)
+            while pending:
+                time.sleep(0.1)
+                for path in list(pending):
+                    with open(path, "r") as f:
+                        status = f.read().strip()
+                    if status != "-1":
+                        pending.remove(path)
+                if pending and time.monotonic() > deadline:
+                    return False
+        except OSError as e:
+            # no write permission on therm_bulk_read, or the master went away:
+            # stop trying and stay on the sequential path
+            logging.debug("bulk read not available: %s", e)
+            self._bulk = False
+            return False
+        return True
+
+    def _read_temp(self, index):
+        sensor = self._sensors[index]
+        gone = False
+        for i in range(3):
+            start = time.perf_counter()
+            try:
+                data = sensor.read()
+            except OSError as e:
+                # unplugged: drop the handle, the next read reopens it if it's back
+                sensor.close()
+                logging.debug("device %s not readable: %s", sensor.id, e)
+                data = b""
+                gone = True
+            sensor.read_time.observe(time.perf_counter() - start)
+
+            temp = parse_w1_slave(data)
+            if temp is None:
+                sensor.retries.inc()
+                time.sleep(0.1)
+                continue
+
+            now = time.monotonic()
+            if sensor.value is not None and sensor.read_at is not None and now > sensor.read_at:
+                sensor.rate = (temp - sensor.value) / (now - sensor.read_at) * 60
+            sensor.value = temp
+            sensor.read_at = now
+            sensor.time = time.time()
+            break
+        else:
+            sensor.failures.inc()
+            if gone:
+                sensor.value = None     # a bad CRC keeps the last reading, a missing sensor doesn't
+            logging.debug(f"failed to read device {index}")
+        sensor.due = time.monotonic() + sensor.policy.interval(sensor.value, sensor.rate)
+
+    def tempC(self, index=0):
+        try:
+            return self._sensors[index].value
+        except:
+            logging.debug("check temp sensor connections")
+
+    def read_at(self, index=0):
+        """Wall clock time of the sensor's last good read, 0.0 if never read"""
+        try:
+            return self._sensors[index].time
+        except IndexError:
+            return None
+
+    def device_count(self):
+        """Return the number of discovered devices"""
+        return self._num_devices
@@ -0,0 +1,142 @@
+import logging
+import math
+import os
+import struct
+import time
+from array import array
+
+#####################################################################################
+###  Precomputed sunrise / sunset table
+###
+###  - one pass of the NOAA sunrise equation over a whole year of days for a site,
+###    times stored as UTC epoch seconds so no timezone library is needed
+###  - saved as a small binary file (header + two int64 arrays, ~6KB a year)
+###  - is_dark() and seconds_to_next() are O(1) lookups by day index
+###
+###  a "day" is the solar day at the site's longitude, so sunrise and sunset of
+###  one local date always land in the same slot
+#####################################################################################
+
+MAGIC = b"SUN1"
+HEADER = struct.Struct("<4sddqq")       # magic, latitude, longitude, first day, days
+
+J1970 = 2440587.5                       # julian date of the unix epoch
+J2000 = 2451545.0
+SUN_ALTITUDE = -0.833                   # refraction + solar disc, same as suntime
+
+
+def _solar_day(ts, longitude):
+    """Day number (days since 1970-01-01) of the solar day ts falls in"""
+    return math.floor(ts / 86400 + longitude / 360)
+
+
+def compute(latitude, longitude, first_day, days):
+    """Sunrise and sunset epoch seconds for `days` days from first_day"""
+    rises = array("q", [0]) * days
+    sets = array("q", [0]) * days
+    sin_lat = math.sin(math.radians(latitude))
+    cos_lat = math.cos(math.radians(latitude))
+    sin_alt = math.sin(math.radians(SUN_ALTITUDE))
+    sin_tilt = math.sin(math.radians(23.4397))
+
+    for i in range(days):
+        n = first_day + i + J1970 + 0.5 - J2000         # days since J2000 at noon
+        mean_noon = n - longitude / 360
+        m = math.radians((357.5291 + 0.98560028 * mean_noon) % 360)
+        centre = 1.9148 * math.sin(m) + 0.02 * math.sin(2 * m) + 0.0003 * math.sin(3 * m)
+        ecl_long = math.radians((math.degrees(m) + centre + 180 + 102.9372) % 360)
+        transit = J2000 + mean_noon + 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * ecl_long)
+        sin_dec = math.sin(ecl_long) * sin_tilt
+        cos_dec = math.cos(math.asin(sin_dec))
+        cos_hour = (sin_alt - sin_lat * sin_dec) / (cos_lat * cos_dec)
+        # polar night / midnight sun: no crossing, collapse or stretch the day
+        hour = math.degrees(math.acos(max(-1.0, min(1.0, cos_hour))))
+        rises[i] = round((transit - hour / 360 - J1970) * 86400)
+        sets[i] = round((transit + hour / 360 - J1970) * 86400)
+    return rises, sets
+
+
+class SunTable:
+
+    def __init__(self, latitude, longitude, first_day, rises, sets, path=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.first_day = first_day
+        self.rises = rises
+        self.sets = sets
+        self.path = path
+
+    @classmethod
+    def build(cls, latitude, longitude, now=None, days=400, path=None):
+        """Compute a table starting yesterday, covering a bit over a year"""
+        if now is None:
+            now = time.time()
+        first_day = _solar_day(now, longitude) - 1
+        rises, sets = compute(latitude, longitude, first_day, days)
+        table = cls(latitude, longitude, first_day, rises, sets, path)
+        logging.debug("built sun table for %s, %s: %s days", latitude, longitude, days)
+        if path:
+            table.save(path)
+        return table
+
+    @classmethod
+    def load(cls, path, latitude, longitude, now=None):
+        """Load the table for this site from path, rebuilding it if missing, stale or for another site"""
+        if now is None:
+            now = time.time()
+        try:
+            with open(path, "rb") as f:
+                magic, lat, lon, first_day, days = HEADER.unpack(f.read(HEADER.size))
+                rises = array("q")
+                sets = array("q")
+                rises.fromfile(f, days)
+                sets.fromfile(f, days)
+            if magic != MAGIC or (lat, lon) != (latitude, longitude):
+                raise ValueError("table is for another site")
+            table = cls(lat, lon, first_day, rises, sets, path)
+            if table.covers(now):
+                return table
+            logging.debug("sun table %s is out of date", path)
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            logging.debug("sun table %s not usable: %s", path, e)
+        return cls.build(latitude, longitude, now, path=path)
+
+    def save(self, path):
+        with open(path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, self.latitude, self.longitude, self.first_day, len(self.rises)))
+            self.rises.tofile(f)
+            self.sets.tofile(f)
+        os.replace(path + ".tmp", path)
+
+    def covers(self, ts):
+        # need tomorrow's sunrise too for seconds_to_next()
+        i = _solar_day(ts, self.longitude) - self.first_day
+        return 0 <= i < len(self.rises) - 1
+
+    def _index(self, ts):
+        if not self.covers(ts):
+            # ran past the end of the table, extend it in place
+            fresh = SunTable.build(self.latitude, self.longitude, ts, path=self.path)
+            self.first_day, self.rises, self.sets = fresh.first_day, fresh.rises, fresh.sets
+        return _solar_day(ts, self.longitude) - self.first_day
+
+    def today(self, ts):
+        """(sunrise, sunset) epoch seconds of the day ts falls in"""
+        i = self._index(ts)
+        return self.rises[i], self.sets[i]
+
+    def is_dark(self, ts):
+        i = self._index(ts)
+        return ts < self.rises[i] or ts >= self.sets[i]
+
+    def seconds_to_next(self, ts):
+        """Seconds until the next sunrise or sunset"""
+        i = self._index(ts)
+        if ts < self.rises[i]:
+            return self.rises[i] - ts
+        if ts < self.sets[i]:
+            return self.sets[i] - ts
+        return self.rises[i + 1] - ts
+
+    def minutes_to_next(self, ts):
+        return int(self.seconds_to_next(ts) // 60)
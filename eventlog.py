@@ -0,0 +1,107 @@
+import math
+import os
+import struct
+import sys
+import time
+from array import array
+
+#####################################################################################
+###  Compact binary event log, one file per site
+###
+###  - 14 byte records: time, kind, value, air temp at the time
+###  - STATE records hold the new state (statemachine.py numbers), OUTPUT_ON /
+###    OUTPUT_OFF records the output (OUTPUTS index)
+###  - records collect in memory and are appended by flush(), which the
+###    controller calls once a minute, so the card sees one small write a
+###    minute at most. A power cut loses the last minute of events.
+###
+###  TempLog: temperature samples, one append-only file per column in a
+###  directory (ts.f8, air.f4, water.f4, box.f4), raw values in machine byte
+###  order (little-endian on the Pi), NaN for a missing reading. Each column
+###  can be memory mapped as it is, e.g. numpy.memmap("air.f4", "<f4").
+###
+###  python eventlog.py events.bin       print a log as text
+###  python season.py ...                season report from both (season.py)
+#####################################################################################
+
+MAGIC = b"EVT1"
+RECORD = struct.Struct("<dBBf")     # time, kind, value, air temp (NaN if unknown)
+
+STATE, OUTPUT_ON, OUTPUT_OFF = 1, 2, 3
+KIND_NAMES = {STATE: "state", OUTPUT_ON: "on", OUTPUT_OFF: "off"}
+
+OUTPUTS = ("bubbler_1", "bubbler_2", "bubbler_3", "danger")
+
+# TempLog columns and their array typecodes, ts is written last so it is
+# never longer than the others after a power cut
+TEMP_COLUMNS = (("air", "f"), ("water", "f"), ("box", "f"), ("ts", "d"))
+
+
+class EventLog:
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = bytearray()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+
+    def append(self, ts, kind, value, air=None):
+        self._pending += RECORD.pack(ts, kind, value, math.nan if air is None else air)
+
+    def flush(self):
+        if not self._pending:
+            return
+        with open(self.path, "ab") as f:
+            f.write(self._pending)
+        self._pending.clear()
+
+
+class TempLog:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._pending = [array(code) for _, code in TEMP_COLUMNS]
+
+    def append(self, ts, air, water, box):
+        for column, value in zip(self._pending, (air, water, box, ts)):
+            column.append(math.nan if value is None else value)
+
+    def flush(self):
+        if not self._pending[-1]:
+            return
+        for (name, code), column in zip(TEMP_COLUMNS, self._pending):
+            with open(column_path(self.path, name, code), "ab") as f:
+                column.tofile(f)
+            del column[:]
+
+
+def column_path(path, name, code):
+    return os.path.join(path, f"{name}.f{array(code).itemsize}")
+
+
+def read(path):
+    """Yield (time, kind, value, air) from a log, air None if unknown"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not an event log")
+    # a record torn by a power cut at the end is left out
+    end = len(MAGIC) + (len(data) - len(MAGIC)) // RECORD.size * RECORD.size
+    for ts, kind, value, air in RECORD.iter_unpack(data[len(MAGIC):end]):
+        yield ts, kind, value, None if math.isnan(air) else air
+
+
+def describe(kind, value):
+    if kind == STATE:
+        import statemachine
+        return f"state {statemachine.STATE_NAMES.get(value, value)}"
+    name = OUTPUTS[value] if value < len(OUTPUTS) else value
+    return f"{name} {KIND_NAMES.get(kind, kind)}"
+
+
+if __name__ == "__main__":
+    for ts, kind, value, air in read(sys.argv[1]):
+        temp = "" if air is None else f"  air {air:.1f}"
+        print(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts)), describe(kind, value) + temp)
@@ -0,0 +1,146 @@
+import bisect
+import math
+from collections import deque
+
+import metrics
+
+#####################################################################################
+###  Streaming filter between the DS18B20 readings and the state machine
+###
+###  one SensorFilter per reading (air, water, box), fed every sample:
+###  - invalid readings (failed read, outside the sensor's range) are rejected,
+###    the last filtered value is kept until no good reading for `stale` secs
+###  - given the time the sensor actually read the value, a reading that is
+###    handed in again (the sensor wasn't due in this sweep, or keeps failing
+###    its CRC and holds its last value) isn't added again, and goes stale by
+###    its age
+###  - rolling median of the last `median` good readings, so one bad sample
+###    never gets through
+###  - EMA with time constant `ema` secs (0: off), time based so it doesn't
+###    care how often the sensor is polled
+###  - dwell: with thresholds, a move across a threshold only goes through
+###    once the input has stayed on the new side for `dwell` secs
+###  each step is O(1) per sample (the median window is a small constant)
+#####################################################################################
+
+# the DS18B20's measuring range, deg C
+VALID_RANGE = (-55.0, 125.0)
+
+
+class Median:
+    """Median of the last n values"""
+
+    def __init__(self, n):
+        self.n = n
+        self._window = deque(maxlen=n)
+        self._sorted = []
+
+    def add(self, value):
+        window, ordered = self._window, self._sorted
+        if len(window) == self.n:
+            ordered.remove(window[0])       # the oldest, about to drop off the window
+        window.append(value)
+        bisect.insort(ordered, value)
+        n = len(ordered)
+        if n & 1:
+            return ordered[n >> 1]
+        return (ordered[(n >> 1) - 1] + ordered[n >> 1]) / 2
+
+    def clear(self):
+        self._window.clear()
+        self._sorted.clear()
+
+
+class Ema:
+    """Exponential moving average with a time constant in seconds"""
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.value = None
+        self._at = None
+
+    def add(self, ts, value):
+        if self.value is None:
+            self.value, self._at = value, ts
+        elif ts > self._at:
+            self.value += (1 - math.exp(-(ts - self._at) / self.tau)) * (value - self.value)
+            self._at = ts
+        return self.value
+
+    def clear(self):
+        self.value = self._at = None
+
+
+class Dwell:
+    """Hold the output on its side of every threshold until the input has been across for `seconds`"""
+
+    def __init__(self, thresholds, seconds):
+        self.thresholds = sorted(thresholds)
+        self.seconds = seconds
+        self.value = None
+        self._band = None
+        self._since = None          # time the input first crossed into another band
+
+    def add(self, ts, value):
+        band = bisect.bisect(self.thresholds, value)
+        if self._band is None or band == self._band:
+            self._since = None
+        elif self._since is None:
+            self._since = ts
+        if self._since is not None and ts - self._since < self.seconds:
+            return self.value
+        self._band = band
+        self._since = None
+        self.value = value
+        return value
+
+    def clear(self):
+        self.value = self._band = self._since = None
+
+
+class SensorFilter:
+
+    def __init__(self, median=5, ema=0, stale=300, dwell=0, thresholds=(), valid=VALID_RANGE, **labels):
+        self.low, self.high = valid
+        self.stale = stale
+        self.median = Median(median) if median > 1 else None
+        self.ema = Ema(ema) if ema > 0 else None
+        self.dwell = Dwell(thresholds, dwell) if dwell > 0 and thresholds else None
+        self.value = None
+        self._good_at = None
+        self._read_at = None        # sensor's time of the last reading added, kept over reset()
+        self.rejected = metrics.counter("bubbler_sensor_rejected_total", "readings dropped by the filter", **labels)
+
+    def add(self, ts, value, read_at=None):
+        """Filter one sample, returns the filtered value (None: no usable reading).
+
+        read_at is when the sensor read the value, if known.
+        """
+        if value is not None and read_at is not None:
+            if self._read_at is not None and read_at <= self._read_at:
+                # the same reading again
+                if self.value is not None and ts - read_at > self.stale:
+                    self.reset()
+                return self.value
+            self._read_at = read_at
+        if value is None or not self.low <= value <= self.high:
+            self.rejected.inc()
+            if self.value is not None and ts - self._good_at > self.stale:
+                self.reset()
+            return self.value
+        self._good_at = ts if read_at is None else read_at
+        if self.median is not None:
+            value = self.median.add(value)
+        if self.ema is not None:
+            value = self.ema.add(ts, value)
+        if self.dwell is not None:
+            value = self.dwell.add(ts, value)
+        self.value = round(value, 2)
+        return self.value
+
+    def reset(self):
+        """Forget everything, the next good reading starts over"""
+        for stage in (self.median, self.ema, self.dwell):
+            if stage is not None:
+                stage.clear()
+        self.value = self._good_at = None
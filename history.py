@@ -0,0 +1,196 @@
+import math
+import threading
+from array import array
+
+#####################################################################################
+###  Fixed memory temperature history
+###
+###  - raw ring buffer of (timestamp, air, water, box) samples
+###  - rolled up automatically into 1 minute, 1 hour and 1 day min/mean/max tiers
+###  - window() returns memoryviews into the ring, nothing is copied
+###
+###  a missing reading (None from DS18B20.tempC) is stored as NaN and left out
+###  of the rollups
+###
+###  values are float32, plenty for the sensor's 1/16 deg C steps. The last
+###  row is also kept as handed in, so latest() gives -3.6 rather than
+###  -3.5999999046325684 and costs no array read.
+#####################################################################################
+
+CHANNELS = ("air", "water", "box")
+STATS = ("min", "mean", "max")
+
+NAN = float("nan")
+
+
+class Ring:
+    """Ring buffer of timestamps plus one float array per column"""
+
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self.ts = array("d", [0.0]) * capacity
+        self.cols = {name: array("f", [NAN]) * capacity for name in columns}
+        self._order = list(self.cols.values())
+        self._index = {name: i for i, name in enumerate(self.cols)}
+        self.next = 0       # slot the next row is written to
+        self.count = 0      # rows held, up to capacity
+        self.row = None     # the last row as appended, None for a missing value
+
+    def append(self, ts, row):
+        """Add a row, values in column order"""
+        i = self.next
+        self.ts[i] = ts
+        for col, value in zip(self._order, row):
+            col[i] = NAN if value is None else value
+        i += 1
+        self.next = 0 if i == self.capacity else i
+        if self.count < self.capacity:
+            self.count += 1
+        self.row = row
+
+    def last(self, name):
+        row = self.row
+        return None if row is None else row[self._index[name]]
+
+    def _slot(self, n):
+        """Slot of the n'th oldest row"""
+        return (self.next - self.count + n) % self.capacity
+
+    def _first_at_or_after(self, since):
+        # rows are in time order once unwrapped, so binary search on the logical index
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.ts[self._slot(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, name, since):
+        """Rows with ts >= since as at most two (timestamps, values) memoryview pairs"""
+        first = self._first_at_or_after(since)
+        if first == self.count:
+            return []
+        start = self._slot(first)
+        end = self.next if self.count < self.capacity or self.next else self.capacity
+        ts = memoryview(self.ts)
+        values = memoryview(self.cols[name])
+        if start < end:
+            return [(ts[start:end], values[start:end])]
+        return [(ts[start:], values[start:]), (ts[:end], values[:end])]
+
+    def nbytes(self):
+        return self.ts.itemsize * self.capacity + sum(
+            col.itemsize * self.capacity for col in self.cols.values())
+
+
+class Tier:
+    """min/mean/max rollup of fixed length buckets, feeding the next coarser tier"""
+
+    def __init__(self, name, period, capacity, parent=None):
+        self.name = name
+        self.period = period
+        self.parent = parent
+        self.ring = Ring(capacity, [f"{ch}_{stat}" for ch in CHANNELS for stat in STATS])
+        self._bucket = None             # start of the open bucket
+        self._end = None                # and its end
+        self._reset()
+
+    def _reset(self):
+        # per channel, in CHANNELS order
+        self._min = [math.inf] * len(CHANNELS)
+        self._max = [-math.inf] * len(CHANNELS)
+        self._sum = [0.0] * len(CHANNELS)
+        self._n = [0] * len(CHANNELS)
+
+    def _open(self, ts):
+        """Close the open bucket (if any) and start the one ts is in"""
+        if self._bucket is not None:
+            self.close()
+        self._bucket = ts - ts % self.period
+        self._end = self._bucket + self.period
+
+    def add_sample(self, ts, values):
+        """Fold in one raw sample, None for a missing reading"""
+        if self._bucket is None or not self._bucket <= ts < self._end:
+            self._open(ts)
+        mins, maxs, sums, counts = self._min, self._max, self._sum, self._n
+        for i, value in enumerate(values):
+            if value is not None:
+                if value < mins[i]:
+                    mins[i] = value
+                if value > maxs[i]:
+                    maxs[i] = value
+                sums[i] += value
+                counts[i] += 1
+
+    def add_bucket(self, ts, mins, sums, counts, maxs):
+        """Fold in a closed bucket of the finer tier"""
+        if self._bucket is None or not self._bucket <= ts < self._end:
+            self._open(ts)
+        my_mins, my_maxs, my_sums, my_counts = self._min, self._max, self._sum, self._n
+        for i, n in enumerate(counts):
+            if n:
+                if mins[i] < my_mins[i]:
+                    my_mins[i] = mins[i]
+                if maxs[i] > my_maxs[i]:
+                    my_maxs[i] = maxs[i]
+                my_sums[i] += sums[i]
+                my_counts[i] += n
+
+    def close(self):
+        mins, sums, counts, maxs = self._min, self._sum, self._n, self._max
+        row = []
+        for low, total, n, high in zip(mins, sums, counts, maxs):
+            row += (low, total / n, high) if n else (None, None, None)
+        self.ring.append(self._bucket, row)
+        if self.parent:
+            self.parent.add_bucket(self._bucket, mins, sums, counts, maxs)
+        self._reset()
+
+
+class TempHistory:
+
+    # raw samples: 6h at the 2s sweep cadence, then 1 week of minutes,
+    # ~200 days of hours and 3 years of days. About 1MB in total.
+    def __init__(self, raw_capacity=10800, minutes=7 * 24 * 60, hours=200 * 24, days=3 * 366):
+        self._lock = threading.Lock()
+        self.raw = Ring(raw_capacity, CHANNELS)
+        day = Tier("1d", 86400, days)
+        hour = Tier("1h", 3600, hours, parent=day)
+        self._minutes = Tier("1m", 60, minutes, parent=hour)
+        self.tiers = {"1m": self._minutes, "1h": hour, "1d": day}
+
+    def append(self, ts, air, water, box):
+        sample = (air, water, box)
+        with self._lock:
+            self.raw.append(ts, sample)
+            self._minutes.add_sample(ts, sample)
+
+    def latest(self, channel):
+        """Most recent reading for a channel, None if missing"""
+        # no lock: the row is swapped in whole and a reader racing append()
+        # just gets the previous sample
+        return self.raw.last(channel)
+
+    def latest_sample(self):
+        """Most recent (air, water, box), None for a missing reading"""
+        return self.raw.row or (None,) * len(CHANNELS)
+
+    def window(self, channel, seconds, tier=None, stat="mean", now=None):
+        """Last `seconds` of a channel as a list of (timestamps, values) memoryviews.
+
+        tier=None reads raw samples, otherwise "1m", "1h" or "1d" with stat one
+        of min/mean/max. The views point into the ring buffer, so use them
+        before too many newer samples overwrite the window.
+        """
+        if now is None:
+            now = self.raw.ts[self.raw.next - 1] if self.raw.count else 0.0
+        with self._lock:
+            if tier is None:
+                return self.raw.window(channel, now - seconds)
+            return self.tiers[tier].ring.window(f"{channel}_{stat}", now - seconds)
+
+    def nbytes(self):
+        return self.raw.nbytes() + sum(t.ring.nbytes() for t in self.tiers.values())
@@ -1,17 +1,8 @@
-import json
+from persist import SaveData
 
-bubbler_main = "0"
-statemachine = "0"
-auto_bubble = "0"
-bubbler_1 = "0"
-bubbler_2 = "0"
-bubbler_3 = "0"
-danger_lights = "0"
-
-jsonData = {"mainkey": bubbler_main, "statekey": statemachine, "autokey": auto_bubble, "b1key": bubbler_1, "b2key": bubbler_2, "b3key": bubbler_3, "dangerkey": danger_lights}
+### write savedata.json with every value off, the schema lives in persist.DEFAULTS
 
 try:
-    with open('savedata.json', 'w') as f:
-        json.dump(jsonData, f)
-except:
+    SaveData('savedata.json').reset()
+except OSError:
         print ("Error! Could not save")
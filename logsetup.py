@@ -0,0 +1,131 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+import metrics
+
+#####################################################################################
+###  Logging off the control path
+###
+###  - every logger call only formats a record and drops it on a queue, one
+###    background thread (QueueListener) does the file and console writes, so
+###    a slow SD card never stalls the main loop
+###  - the log file rotates by size and/or age, old files are gzipped
+###  - repeats of the same line (e.g. "failed to read device 2" every sweep)
+###    are let through a few times per period, then counted and summarized
+#####################################################################################
+
+
+class RateLimitFilter(logging.Filter):
+    """Let `burst` identical lines through every `period` seconds.
+
+    The count of the ones held back is added to the first line let through
+    after the period.
+    """
+
+    def __init__(self, burst=5, period=60.0):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self._seen = {}         # (logger, level, message) -> [window start, count]
+
+    def filter(self, record):
+        now = time.monotonic()
+        # format once here, QueueHandler would do it next anyway
+        message = record.getMessage()
+        record.msg, record.args = message, None
+        key = (record.name, record.levelno, message)
+        seen = self._seen.get(key)
+        if seen is None or now - seen[0] >= self.period:
+            suppressed = seen[1] - self.burst if seen else 0
+            if len(self._seen) > 1000:
+                self._seen.clear()      # a flood of one-off lines, start over
+            self._seen[key] = [now, 1]
+            if suppressed > 0:
+                record.msg = f"{message} ({suppressed} more like this suppressed)"
+            return True
+        seen[1] += 1
+        return seen[1] <= self.burst
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: if the writer falls behind, records are dropped and counted"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = metrics.counter("bubbler_log_dropped_total", "log records dropped, queue full")
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped.inc()
+
+
+class RotatingFile(logging.handlers.RotatingFileHandler):
+    """Rotates at max_bytes or every `interval` seconds, whichever comes first, gzipping old files"""
+
+    def __init__(self, path, max_bytes=1_000_000, backups=5, interval=None):
+        super().__init__(path, maxBytes=max_bytes, backupCount=backups, delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._gzip
+
+    @staticmethod
+    def _gzip(source, dest):
+        import gzip, shutil     # only needed once a rotation is due
+        with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+def setup(file="debug.log", level="DEBUG", max_bytes=1_000_000, backups=5, rotate_hours=None,
+          console=True, burst=5, period=60.0, queue_size=10000):
+    """Route the root logger through a queue to a rotating file and the console.
+
+    Returns the QueueListener, which is also stopped (flushing the queue) at exit.
+    """
+    fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    handlers = []
+    if file:
+        handler = RotatingFile(file, max_bytes, backups, rotate_hours * 3600 if rotate_hours else None)
+        handler.setFormatter(fmt)
+        handlers.append(handler)
+    if console:
+        handler = logging.StreamHandler()
+        handler.setFormatter(fmt)
+        handlers.append(handler)
+
+    q = queue.Queue(queue_size)
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    front = DroppingQueueHandler(q)
+    front.addFilter(RateLimitFilter(burst, period))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(front)
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(_stop, listener)
+    return listener
+
+
+def _stop(listener):
+    if listener._thread is not None:        # not already stopped by the caller
+        listener.stop()
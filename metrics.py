@@ -0,0 +1,186 @@
+import bisect
+import json
+import threading
+
+#####################################################################################
+###  Runtime metrics
+###
+###  - counters, gauges and fixed bucket histograms, kept in plain python
+###    numbers: an update is an attribute add or a bisect, no locks, no I/O
+###  - everything registers in REGISTRY under a name plus labels, asking for
+###    the same name and labels again returns the same metric
+###  - serve(port) exposes REGISTRY in the Prometheus text format on
+###    http://<host>:<port>/metrics, snapshot() gives the same as a dict for
+###    the MQTT metrics topic
+###
+###  updates from different threads can very rarely lose an increment, which
+###  is fine for monitoring and much cheaper than locking every hot path
+#####################################################################################
+
+# seconds, from a fast dispatch up to a stalled loop or a hung 1-Wire read
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 10.0)
+
+
+class Counter:
+    """Only goes up. With fn the value is read from it when scraped."""
+
+    kind = "counter"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Gauge:
+    """A value that goes up and down. With fn the value is read from it when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.fn() if self.fn else self.value
+
+
+class Histogram:
+
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        return {"count": self.count, "sum": round(self.sum, 6)}
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _label_text(labels, extra=()):
+    pairs = labels + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs) + "}"
+
+
+class Registry:
+
+    def __init__(self):
+        self._families = {}     # name -> (kind, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        key = _labels(labels)
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (cls.kind, help, {})
+            elif family[0] != cls.kind:
+                raise ValueError(f"metric {name} is already a {family[0]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = cls(**kwargs)
+            elif kwargs.get("fn"):
+                metric.fn = kwargs["fn"]        # a restarted site takes over its gauges
+            return metric
+
+    def counter(self, name, help, fn=None, **labels):
+        return self._get(Counter, name, help, labels, fn=fn)
+
+    def gauge(self, name, help, fn=None, **labels):
+        return self._get(Gauge, name, help, labels, fn=fn)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def _collect(self):
+        with self._lock:
+            return [(name, kind, help, list(metrics.items()))
+                    for name, (kind, help, metrics) in sorted(self._families.items())]
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for name, kind, help, metrics in self._collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind != "histogram":
+                    lines.append(f"{name}{_label_text(labels)} {metric.get()}")
+                    continue
+                total = 0
+                for bound, n in zip(metric.buckets + ("+Inf",), metric.counts):
+                    total += n
+                    lines.append(f"{name}_bucket{_label_text(labels, [('le', str(bound))])} {total}")
+                lines.append(f"{name}_sum{_label_text(labels)} {metric.sum}")
+                lines.append(f"{name}_count{_label_text(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{name: {"label=value,...": value}}, histograms as count and sum"""
+        snap = {}
+        for name, kind, help, metrics in self._collect():
+            snap[name] = {",".join(f"{k}={v}" for k, v in labels): metric.get()
+                          for labels, metric in metrics}
+        return snap
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+#################################################################################
+###  Scrape endpoint
+#################################################################################
+
+def serve(port, host="127.0.0.1", registry=REGISTRY):
+    """Serve the registry on http://host:port/metrics from a daemon thread"""
+    # imported here, http.server is most of the import time of this module
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path not in ("/", "/metrics", "/metrics.json"):
+                self.send_error(404)
+                return
+            if path == "/metrics.json":
+                body, ctype = json.dumps(registry.snapshot()).encode(), "application/json"
+            else:
+                body, ctype = registry.render().encode(), "text/plain; version=0.0.4"
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass        # scrapes every 15s would drown debug.log
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
@@ -0,0 +1,187 @@
+import threading
+import time
+
+import metrics
+
+#####################################################################################
+###  Output devices (bubblers, danger lights)
+###
+###  - a site's outputs are one OutputBank: set({"bubbler_1": 0, "bubbler_2": 1})
+###    writes several outputs in one operation where the backend can, so a
+###    bubbler swap has no moment with both (or neither) running. Where it
+###    can't, outputs going off are written before outputs going on, so
+###    there can be a moment with neither but never one with both.
+###  - bank.output(name) is a single output with the on(), off() and .value a
+###    site uses, the part of gpiozero's OutputDevice it always used
+###  - backends: "gpiod" (one line request, a group is one ioctl), "gpio" /
+###    "gpiozero" (a device per pin, a group is written pin by pin) and "mock"
+###    (in memory, for the simulator, benchmarks and boxes without GPIO).
+###    gpiod and gpiozero are only imported when a bank of that kind is made.
+###  - gpiozero can drive the pins of another Pi through its pigpiod (host),
+###    which is how a gateway runs the outputs of a remote dock
+###  - every bank counts its writes and times them (bubbler_gpio_writes_total,
+###    bubbler_gpio_write_seconds). Writes that change nothing are skipped.
+#####################################################################################
+
+
+class OutputBank:
+    """The outputs of one site, by name (bubbler_1, bubbler_2, bubbler_3, danger)"""
+
+    def __init__(self, pins, chip=None, host=None, **labels):
+        self.pins = dict(pins)
+        self.values = dict.fromkeys(self.pins, 0)
+        self.writes = 0                 # number of hardware writes
+        self.written_at = None          # perf_counter() at the end of the last write
+        self._lock = threading.Lock()   # the watchdog's safe state writes from its own thread
+        self._write_time = metrics.histogram("bubbler_gpio_write_seconds", "time to write a group of outputs",
+                                             **labels)
+        metrics.counter("bubbler_gpio_writes_total", "output writes, one per group", fn=lambda: self.writes,
+                        **labels)
+
+    def set(self, changes):
+        """Write {name: 0/1}, every output that changes in one operation (offs first where it takes several).
+
+        Returns the values before the write of the outputs it changed.
+        """
+        with self._lock:
+            changes = {name: int(bool(value))
+                       for name, value in sorted(changes.items(), key=lambda item: bool(item[1]))
+                       if self.values[name] != bool(value)}
+            if not changes:
+                return {}
+            before = {name: self.values[name] for name in changes}
+            start = time.perf_counter()
+            self._write(changes)
+            self.written_at = time.perf_counter()
+            self.values.update(changes)
+            self.writes += 1
+        self._write_time.observe(self.written_at - start)
+        return before
+
+    def output(self, name):
+        return BankOutput(self, name)
+
+    def _write(self, changes):
+        raise NotImplementedError
+
+
+class BankOutput:
+    """One output of a bank"""
+
+    def __init__(self, bank, name):
+        self.bank = bank
+        self.name = name
+        self.pin = bank.pins[name]
+
+    @property
+    def value(self):
+        return self.bank.values[self.name]
+
+    def on(self):
+        self.bank.set({self.name: 1})
+
+    def off(self):
+        self.bank.set({self.name: 0})
+
+
+class MockBank(OutputBank):
+    """In-memory outputs"""
+
+    def _write(self, changes):
+        pass
+
+
+class GpiozeroBank(OutputBank):
+    """A gpiozero OutputDevice per pin, on another Pi's pigpiod if host is given"""
+
+    def __init__(self, pins, chip=None, host=None, **labels):
+        super().__init__(pins, **labels)
+        from gpiozero import OutputDevice
+        factory = None
+        if host:
+            from gpiozero.pins.pigpio import PiGPIOFactory
+            factory = PiGPIOFactory(host=host)
+        self.devices = {name: OutputDevice(pin, active_high=True, initial_value=False, pin_factory=factory)
+                        for name, pin in self.pins.items()}
+
+    def _write(self, changes):
+        for name, value in changes.items():
+            self.devices[name].value = value
+
+
+class GpiodBank(OutputBank):
+    """Every pin in one libgpiod (v2) line request, a group is a single set_values()"""
+
+    default_chip = "/dev/gpiochip0"
+
+    def __init__(self, pins, chip=None, host=None, **labels):
+        super().__init__(pins, **labels)
+        import gpiod
+        from gpiod.line import Direction, Value
+        self._levels = (Value.INACTIVE, Value.ACTIVE)
+        settings = gpiod.LineSettings(direction=Direction.OUTPUT, output_value=Value.INACTIVE)
+        self._request = gpiod.request_lines(chip or self.default_chip, consumer="bubbler",
+                                            config={tuple(self.pins.values()): settings})
+
+    def _write(self, changes):
+        self._request.set_values({self.pins[name]: self._levels[value] for name, value in changes.items()})
+
+
+class MeteredOutput:
+    """Wraps an output device to add up its on-time and switch cycles"""
+
+    def __init__(self, device, clock, on_change=None, **labels):
+        self.device = device
+        self.clock = clock
+        self.on_change = on_change      # called with True/False when the output actually switches
+        self.switches = 0
+        self._on_seconds = 0.0
+        self._since = clock.monotonic() if device.value else None
+        metrics.counter("bubbler_output_on_seconds_total", "seconds the output was on",
+                        fn=self.on_seconds, **labels)
+        metrics.counter("bubbler_output_switches_total", "times the output was switched on",
+                        fn=lambda: self.switches, **labels)
+
+    @property
+    def value(self):
+        return self.device.value
+
+    def on(self):
+        was = self.device.value
+        self.device.on()
+        self.changed(was, 1)
+
+    def off(self):
+        was = self.device.value
+        self.device.off()
+        self.changed(was, 0)
+
+    def changed(self, was, now):
+        """Account for a write, made here or by a group write on the bank"""
+        if bool(was) == bool(now):
+            return
+        if now:
+            self._since = self.clock.monotonic()
+            self.switches += 1
+        elif self._since is not None:
+            self._on_seconds += self.clock.monotonic() - self._since
+            self._since = None
+        if self.on_change:
+            self.on_change(bool(now))
+
+    def on_seconds(self):
+        """Total on-time, including the current stretch if on now"""
+        if self._since is None:
+            return self._on_seconds
+        return self._on_seconds + self.clock.monotonic() - self._since
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+
+BACKENDS = {
+    "gpio": GpiozeroBank,
+    "gpiozero": GpiozeroBank,
+    "gpiod": GpiodBank,
+    "mock": MockBank,
+}
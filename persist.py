@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+#####################################################################################
+###  Persistent savedata.json
+###
+###  - owns the schema (DEFAULTS) that initialize-file.py used to write by hand
+###  - update() only marks values dirty, a background writer batches all the
+###    changes made within `delay` seconds into one write. Without the
+###    background writer (the simulator) the owner calls flush() once `due`.
+###  - writes are atomic: temp file + fsync + rename + fsync of the directory,
+###    so a power cut leaves either the old or the new file, never half of one
+###  - load() falls back to defaults if the file is missing or torn
+#####################################################################################
+
+DEFAULTS = {
+    "mainkey": 0,       # bubbler_main, master power
+    "statekey": 0,      # state machine state, for reference: it isn't restored
+    "autokey": 0,       # auto_bubble
+    "b1key": 0,         # bubbler_1 output, the outputs are restored while auto_bubble is off
+    "b2key": 0,         # bubbler_2 output
+    "b3key": 0,         # bubbler_3 output
+    "dangerkey": 0,     # danger lights output
+    "airtemp": None,    # last temperatures (deg C) and when they were read,
+    "watertemp": None,  # so a restart can carry on before the first sweep
+    "boxtemp": None,
+    "tempts": 0,
+}
+
+
+def _cast(key, value):
+    # temperatures are floats or None, everything else an int
+    if DEFAULTS[key] is None:
+        return None if value is None else round(float(value), 2)
+    return int(value)
+
+
+class SaveData:
+
+    def __init__(self, path, delay=2.0, monotonic=time.monotonic):
+        self.path = path
+        self.delay = delay
+        self.monotonic = monotonic
+        self.background = True          # False: no writer thread, the owner calls flush() when due
+        self.dry_run = False            # True: count the writes without making them (the simulator)
+        self.writes = 0                 # number of times the file was actually written
+        self.writing = None             # monotonic time the write in progress started
+        self._write_time = metrics.histogram("bubbler_savedata_write_seconds",
+                                             "time to write and fsync savedata", file=path)
+        self._errors = metrics.counter("bubbler_savedata_errors_total",
+                                       "failed savedata writes", file=path)
+        self._data = dict(DEFAULTS)
+        self._dirty = False
+        self._due = None                # time the pending batch gets written
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()     # one _write() at a time, they share the temp file
+        self._writer = None
+
+    def load(self):
+        """Read the file, recovering from a missing or torn one. Returns the values."""
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("not a json object")
+        except FileNotFoundError:
+            logging.warning("%s not found, starting from defaults", self.path)
+            data = {}
+        except ValueError as e:
+            # a torn write from before writes were atomic, or a corrupt card
+            logging.warning("%s unreadable (%s), starting from defaults", self.path, e)
+            data = {}
+
+        with self._cond:
+            self._data = dict(DEFAULTS)
+            for key in DEFAULTS:
+                if key in data:
+                    try:
+                        self._data[key] = _cast(key, data[key])
+                    except (TypeError, ValueError):
+                        logging.warning("bad value for %s in %s: %r", key, self.path, data[key])
+            return dict(self._data)
+
+    def update(self, **values):
+        """Change some values, the write happens later on the writer thread"""
+        with self._cond:
+            values = {k: _cast(k, v) for k, v in values.items()}
+            changed = {k: v for k, v in values.items() if self._data.get(k) != v}
+            if not changed:
+                return
+            self._data.update(changed)
+            if not self._dirty:
+                self._dirty = True
+                self._due = self.monotonic() + self.delay
+            if self.background and self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="savedata", daemon=True)
+                self._writer.start()
+            self._cond.notify()
+
+    @property
+    def due(self):
+        """monotonic() time the pending changes are written, None if there are none"""
+        return self._due if self._dirty else None
+
+    def flush(self):
+        """Write any pending changes now, e.g. before shutdown"""
+        with self._write_lock:
+            data = self._take()
+            if data is not None:
+                self._write(data)
+
+    def reset(self):
+        """Write the default values straight away"""
+        with self._write_lock:
+            with self._cond:
+                self._data = dict(DEFAULTS)
+                self._dirty = False
+            self._write(dict(DEFAULTS))
+
+    def _take(self):
+        """The values to write and nothing pending, None if nothing was"""
+        with self._cond:
+            if not self._dirty:
+                return None
+            self._dirty = False
+            return dict(self._data)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                wait = self._due - self.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+            # the values are taken under the write lock, so a flush() in between
+            # can't be overwritten by the older values taken here
+            with self._write_lock:
+                data = self._take()
+                if data is None:
+                    continue        # flushed in the meantime
+                try:
+                    self._write(data)
+                except OSError as e:
+                    self._errors.inc()
+                    logging.error("could not save %s: %s", self.path, e)
+                    # try again later rather than losing the change
+                    with self._cond:
+                        if not self._dirty:
+                            self._dirty = True
+                            self._due = self.monotonic() + max(self.delay, 10)
+
+    def _write(self, data):
+        if self.dry_run:
+            self.writes += 1
+            return
+        logging.debug("writing %s", self.path)
+        self.writing = time.monotonic()
+        start = time.perf_counter()
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            # make the rename itself durable
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        finally:
+            self.writing = None
+        self.writes += 1
+        self._write_time.observe(time.perf_counter() - start)
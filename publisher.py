@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+
+import metrics
+
+#####################################################################################
+###  Change-only MQTT publication
+###
+###  - remembers the last payload sent per topic and drops duplicates
+###  - readings (temperatures) only go out when a value moves by more than
+###    its deadband
+###  - anything suppressed is still resent after max_silence seconds so
+###    subscribers can tell we are alive
+###  - with combine=True the bubbler_1/bubbler_2/danger_lights state topics
+###    are gathered and sent as one json message on <prefix>/state/outputs
+###    when flush() is called
+###  - while offline nothing goes to the client: retained topics only keep
+###    their latest value for republish() on reconnect, readings also go to
+###    the spool (spool.py) if there is one, anything else is dropped
+###  - hold() / release() around a batch of changes: only the last payload
+###    per topic goes out, intermediate values are never published
+#####################################################################################
+
+
+class Publisher:
+
+    def __init__(self, client, prefix, max_silence=300, combine=False, monotonic=time.monotonic,
+                 spool=None, wall=time.time):
+        self.client = client
+        self.monotonic = monotonic
+        self.spool = spool
+        self.wall = wall
+        self.online = True              # cleared by the controller while the broker is unreachable
+        self.prefix = prefix
+        self.max_silence = max_silence
+        self.combine = combine
+        self.sent = 0                   # messages handed to the client
+        self.suppressed = 0             # messages dropped as unchanged
+        self.deferred = 0               # messages held back while offline
+        self._last = {}                 # topic -> (payload, qos, retain, time sent)
+        self._readings = {}             # topic -> values last sent
+        self._outputs = {}              # combined output states not yet flushed
+        self._held = None               # topic -> publish() arguments, between hold() and release()
+        self._lock = threading.Lock()
+        self._counters = {}             # topic -> (sent, suppressed) metrics
+
+    def _count(self, topic):
+        counters = self._counters.get(topic)
+        if counters is None:
+            counters = self._counters[topic] = (
+                metrics.counter("bubbler_mqtt_published_total", "messages published", topic=topic),
+                metrics.counter("bubbler_mqtt_suppressed_total", "unchanged messages not published", topic=topic))
+        return counters
+
+    def publish(self, topic, payload=None, qos=0, retain=False, force=False):
+        """Same arguments as client.publish, but unchanged payloads are dropped"""
+        now = self.monotonic()
+        with self._lock:
+            if self._held is not None:
+                self._held[topic] = (payload, qos, retain, force)
+                return
+            last = self._last.get(topic)
+            if (not force and last is not None and last[0] == payload
+                    and now - last[3] < self.max_silence):
+                self.suppressed += 1
+                self._count(topic)[1].inc()
+                return
+            self._last[topic] = (payload, qos, retain, now)
+            if not self.online:
+                self.deferred += 1
+                return
+            self.sent += 1
+            self._count(topic)[0].inc()
+        self.client.publish(topic, payload, qos, retain)
+
+    def publish_readings(self, topic, values, deadbands, qos=1, retain=True):
+        """Publish a json dict of readings if any moved more than its deadband"""
+        with self._lock:
+            last = self._readings.get(topic)
+            sent = self._last.get(topic)
+            changed = last is None or sent is None or self.monotonic() - sent[3] >= self.max_silence
+            if not changed:
+                for key, value in values.items():
+                    before = last.get(key)
+                    if value is None or before is None:
+                        changed = value is not before
+                    else:
+                        changed = abs(value - before) > deadbands.get(key, 0)
+                    if changed:
+                        break
+            if not changed:
+                self.suppressed += 1
+                self._count(topic)[1].inc()
+                return
+            self._readings[topic] = dict(values)
+        payload = json.dumps(values)
+        if not self.online and self.spool is not None:
+            self.spool.append(self.wall(), topic, payload)
+        self.publish(topic, payload, qos, retain, force=True)
+
+    def state(self, name, payload):
+        """Publish an output state (bubbler_1, bubbler_2, danger_lights)"""
+        if not self.combine:
+            self.publish(f"{self.prefix}/state/{name}", payload, 1, True)
+            return
+        with self._lock:
+            self._outputs[name] = payload
+
+    def hold(self):
+        """Keep publish() calls back until release()"""
+        with self._lock:
+            if self._held is None:
+                self._held = {}
+
+    def release(self):
+        """Publish the last payload held for each topic"""
+        with self._lock:
+            held, self._held = self._held or {}, None
+        for topic, (payload, qos, retain, force) in held.items():
+            self.publish(topic, payload, qos, retain, force)
+
+    def flush(self):
+        """Send the combined output states gathered since the last flush"""
+        with self._lock:
+            if not self._outputs:
+                return
+            outputs = self._outputs
+            self._outputs = {}
+            # merge into the last combined message so it always holds every output
+            last = self._last.get(f"{self.prefix}/state/outputs")
+            merged = json.loads(last[0]) if last else {}
+            merged.update(outputs)
+        self.publish(f"{self.prefix}/state/outputs", json.dumps(merged, sort_keys=True), 1, True)
+
+    def republish(self):
+        """Resend every retained value, e.g. after reconnecting to the broker"""
+        with self._lock:
+            retained = [(topic, last[0], last[1]) for topic, last in self._last.items() if last[2]]
+        for topic, payload, qos in retained:
+            self.publish(topic, payload, qos, True, force=True)
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import eventlog
+import statemachine
+
+#####################################################################################
+###  Season report from a site's event log and temperature log
+###
+###  python season.py events.bin                       run hours, state hours
+###  python season.py events.bin --temps templog/      plus daily minimums
+###  python season.py events.bin --from 2025-11-01 --to 2026-05-01 --json out.json
+###
+###  both logs are memory mapped, nothing is read into memory as a whole: the
+###  event log is small, and the temperatures are only touched one day at a
+###  time. A season takes well under a second.
+#####################################################################################
+
+# eventlog.RECORD as a numpy record, packed like the file
+EVENT_DTYPE = np.dtype([("ts", "<f8"), ("kind", "u1"), ("value", "u1"), ("air", "<f4")])
+
+
+def load_events(path):
+    """The event log as a read-only structured array"""
+    size = os.path.getsize(path) - len(eventlog.MAGIC)
+    with open(path, "rb") as f:
+        if f.read(len(eventlog.MAGIC)) != eventlog.MAGIC:
+            raise ValueError(f"{path} is not an event log")
+    count = size // EVENT_DTYPE.itemsize      # a torn record at the end is left out
+    if count <= 0:
+        return np.zeros(0, EVENT_DTYPE)
+    return np.memmap(path, EVENT_DTYPE, "r", offset=len(eventlog.MAGIC), shape=(count,))
+
+
+def load_temps(path):
+    """{column: read-only array} for a temperature log, all the same length"""
+    columns = {}
+    for name, code in eventlog.TEMP_COLUMNS:
+        file = eventlog.column_path(path, name, code)
+        dtype = np.dtype("<f8" if code == "d" else "<f4")
+        columns[name] = np.memmap(file, dtype, "r") if os.path.getsize(file) else np.zeros(0, dtype)
+    rows = min(len(column) for column in columns.values())
+    return {name: column[:rows] for name, column in columns.items()}
+
+
+def _durations(ts, start, end):
+    """How long each record was in force within [start, end)"""
+    t = np.clip(ts, start, end)
+    return np.diff(np.append(t, end))
+
+
+def state_hours(events, start, end):
+    states = events[events["kind"] == eventlog.STATE]
+    hours = np.bincount(states["value"], weights=_durations(states["ts"], start, end),
+                        minlength=len(statemachine.STATE_NAMES)) / 3600
+    return {name: round(float(hours[state]), 1) for state, name in statemachine.STATE_NAMES.items()}
+
+
+def constant_entries(events, start, end):
+    ts = events["ts"]
+    entered = ((events["kind"] == eventlog.STATE) & (events["value"] == statemachine.CONSTANT)
+               & (ts >= start) & (ts < end))
+    return int(np.count_nonzero(entered))
+
+
+def run_hours(events, start, end):
+    """{output: (run hours, times switched on)}"""
+    kind, value, ts = events["kind"], events["value"], events["ts"]
+    switching = (kind == eventlog.OUTPUT_ON) | (kind == eventlog.OUTPUT_OFF)
+    result = {}
+    for index, name in enumerate(eventlog.OUTPUTS):
+        mine = switching & (value == index)
+        on = kind[mine] == eventlog.OUTPUT_ON
+        when = ts[mine]
+        hours = _durations(when, start, end)[on].sum() / 3600
+        starts = int(np.count_nonzero(on & (when >= start) & (when < end)))
+        result[name] = (round(float(hours), 1), starts)
+    return result
+
+
+def daily_minimums(temps, start, end, columns=("air", "water")):
+    """[(date, {column: min}), ...] for each local day with readings"""
+    ts = temps["ts"]
+    days = []
+    day = datetime.fromtimestamp(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    while day.timestamp() < end:
+        following = day + timedelta(days=1)
+        lo, hi = np.searchsorted(ts, [max(day.timestamp(), start), min(following.timestamp(), end)])
+        if hi > lo:
+            mins = {}
+            for name in columns:
+                low = float(np.fmin.reduce(temps[name][lo:hi]))     # fmin skips NaN
+                mins[name] = None if np.isnan(low) else round(low, 2)
+            days.append((day.date().isoformat(), mins))
+        day = following
+    return days
+
+
+def report(events_path, temps_path=None, start=None, end=None):
+    events = load_events(events_path)
+    temps = load_temps(temps_path) if temps_path else None
+    first = [float(events["ts"][0])] if len(events) else []
+    last = [float(events["ts"][-1])] if len(events) else []
+    if temps is not None and len(temps["ts"]):
+        first.append(float(temps["ts"][0]))
+        last.append(float(temps["ts"][-1]))
+    if not first:
+        raise ValueError("the logs are empty")
+    start = min(first) if start is None else start
+    end = max(last) if end is None else end
+
+    outputs = run_hours(events, start, end)
+    result = {
+        "from": datetime.fromtimestamp(start).isoformat(timespec="seconds"),
+        "to": datetime.fromtimestamp(end).isoformat(timespec="seconds"),
+        "state_hours": state_hours(events, start, end),
+        "constant_entries": constant_entries(events, start, end),
+        "run_hours": {name: hours for name, (hours, _) in outputs.items()},
+        "switch_cycles": {name: starts for name, (_, starts) in outputs.items()},
+    }
+    if temps is not None:
+        result["daily_minimums"] = dict(daily_minimums(temps, start, end))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Season report from a bubbler event log")
+    parser.add_argument("events", help="event log (the site's eventlog setting)")
+    parser.add_argument("--temps", help="temperature log directory (the site's templog setting)")
+    parser.add_argument("--from", dest="start", help="start date or time, default the start of the logs")
+    parser.add_argument("--to", dest="end", help="end date or time, default the end of the logs")
+    parser.add_argument("--json", help="write the report as json here")
+    args = parser.parse_args()
+
+    start = datetime.fromisoformat(args.start).timestamp() if args.start else None
+    end = datetime.fromisoformat(args.end).timestamp() if args.end else None
+    result = report(args.events, args.temps, start, end)
+
+    print(f"{result['from']} .. {result['to']}")
+    print("hours per state:", result["state_hours"])
+    print("CONSTANT entered:", result["constant_entries"])
+    print("run hours:", result["run_hours"])
+    print("switch cycles:", result["switch_cycles"])
+    if "daily_minimums" in result:
+        print("daily minimums:")
+        for day, mins in result["daily_minimums"].items():
+            print(f"  {day}", "  ".join(f"{name} {'-' if low is None else low}" for name, low in mins.items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
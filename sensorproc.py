@@ -0,0 +1,203 @@
+import atexit
+import logging
+import math
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import metrics
+from ds18b20 import DS18B20
+
+#####################################################################################
+###  DS18B20 reader in its own process
+###
+###  - the child runs the usual DS18B20 loop and after every sweep writes the
+###    readings into a shared memory block, seqlock style: the sequence number
+###    is odd while a write is in progress, a reader that sees it odd or sees
+###    it change while reading just reads again. No locks across processes.
+###  - a byte down a pipe wakes the watcher thread here, which reads the block
+###    and calls on_sweep like the in-thread reader does
+###  - the watcher restarts the child if it dies or stops sweeping, and after
+###    `max_restarts` within `restart_window` secs falls back to reading the
+###    sensors on a thread in this process
+###  - SensorProcess has the same ready / tempC() / read_at() / device_count() as DS18B20,
+###    so a site doesn't care which one it has
+###
+###  the child is forked, so it starts at once and shares the block without
+###  pickling anything. Its read metrics stay in the child.
+#####################################################################################
+
+MAX_SENSORS = 16
+HEADER = struct.Struct("<QdI")      # sequence, time of the sweep, number of sensors
+SLOT = struct.Struct("<dd")         # value (NaN: no reading), time of the read
+SIZE = HEADER.size + MAX_SENSORS * SLOT.size
+
+
+def write_block(buf, seq, sensors, ts):
+    """Write a sweep into the block, returns the new sequence number"""
+    count = min(len(sensors), MAX_SENSORS)
+    struct.pack_into("<Q", buf, 0, seq + 1)             # odd: write in progress
+    for i in range(count):
+        value = sensors[i].value
+        SLOT.pack_into(buf, HEADER.size + i * SLOT.size, math.nan if value is None else value, sensors[i].time)
+    HEADER.pack_into(buf, 0, seq + 2, ts, count)
+    return seq + 2
+
+
+def read_block(buf, tries=100):
+    """(time of the sweep, [(value, time), ...]) from the block, None if the writer never let go"""
+    for _ in range(tries):
+        seq, ts, count = HEADER.unpack_from(buf, 0)
+        if seq & 1:
+            continue
+        readings = [SLOT.unpack_from(buf, HEADER.size + i * SLOT.size) for i in range(min(count, MAX_SENSORS))]
+        if struct.unpack_from("<Q", buf, 0)[0] == seq:
+            return ts, [(None if math.isnan(value) else value, at) for value, at in readings]
+    return None
+
+
+def _child(buf, conn, base_dir, bulk, policies):
+    """Entry point of the sensor process"""
+    # the parent's log queue has no listener here
+    root = logging.getLogger()
+    root.handlers[:] = [logging.StreamHandler()]
+    root.setLevel(logging.WARNING)
+    parent = os.getppid()
+    seq = 0
+
+    def sweep_done():
+        nonlocal seq
+        if os.getppid() != parent:
+            os._exit(0)         # the controller is gone
+        seq = write_block(buf, seq, sensor._sensors, time.time())
+        try:
+            conn.send_bytes(b"s")
+        except OSError:
+            os._exit(0)
+
+    sensor = DS18B20(base_dir, on_sweep=sweep_done, bulk=bulk, policies=policies)
+    sensor.run()
+
+
+class SensorProcess:
+
+    # restart a child that hasn't swept for this long (secs), longer than the
+    # slowest poll interval plus a full sweep of retries
+    hung_after = 120
+    max_restarts = 5
+    restart_window = 600
+
+    def __init__(self, base_dir=None, on_sweep=None, bulk=True, policies=None):
+        self._args = (base_dir, bulk, policies)
+        self._on_sweep = on_sweep
+        self._shm = shared_memory.SharedMemory(create=True, size=SIZE)
+        self._shm.buf[:SIZE] = bytes(SIZE)
+        self._readings = []
+        self._restarts = []             # times of recent restarts
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()     # close() against the watcher reading or restarting
+        self._closed = False
+        self.fallback = None            # the in-thread DS18B20, once fallen back to
+        self.ready = threading.Event()
+        self.sweeps = 0                 # for the watchdog
+        self.restarts = metrics.counter("bubbler_sensor_process_restarts_total", "sensor process restarts")
+        atexit.register(self.close)
+
+    def start(self):
+        self._spawn()
+        threading.Thread(target=self._watch, name="sensorproc", daemon=True).start()
+
+    def _spawn(self):
+        ctx = multiprocessing.get_context("fork")
+        receiver, sender = ctx.Pipe(duplex=False)
+        base_dir, bulk, policies = self._args
+        self._process = ctx.Process(target=_child, args=(self._shm.buf, sender, base_dir, bulk, policies),
+                                    name="ds18b20", daemon=True)
+        self._process.start()
+        sender.close()
+        self._conn = receiver
+        logging.info("sensor process %d started", self._process.pid)
+
+    def _watch(self):
+        while True:
+            try:
+                woke = self._conn.poll(self.hung_after)
+                if woke:
+                    self._conn.recv_bytes()
+            except (EOFError, OSError):
+                woke = False
+            with self._lock:
+                if self._closed:
+                    return          # close() killed the child and removed the block
+                if not woke:
+                    # died or hung
+                    if not self._restart():
+                        return
+                    continue
+                snapshot = read_block(self._shm.buf)
+            if snapshot is not None:
+                self._readings = snapshot[1]
+                self.sweeps += 1
+                self.ready.set()
+                if self._on_sweep:
+                    self._on_sweep()
+
+    def _restart(self):
+        """Replace the child, False once it has failed too often and the sensors are read here"""
+        self._process.kill()
+        self._process.join(5)
+        self._conn.close()
+        now = time.monotonic()
+        self._restarts = [t for t in self._restarts if now - t < self.restart_window] + [now]
+        if len(self._restarts) > self.max_restarts:
+            logging.error("sensor process keeps failing, reading the sensors in this process")
+            self._fall_back()
+            return False
+        logging.warning("sensor process %d stopped (exit code %s), restarting",
+                        self._process.pid, self._process.exitcode)
+        self.restarts.inc()
+        self._spawn()
+        return True
+
+    def _fall_back(self):
+        base_dir, bulk, policies = self._args
+        self.fallback = DS18B20(base_dir, on_sweep=self._fallback_sweep, bulk=bulk, policies=policies)
+        self.fallback.start()
+
+    def _fallback_sweep(self):
+        self.sweeps += 1
+        self.ready.set()
+        if self._on_sweep:
+            self._on_sweep()
+
+    def tempC(self, index=0):
+        if self.fallback is not None:
+            return self.fallback.tempC(index)
+        readings = self._readings
+        return readings[index][0] if index < len(readings) else None
+
+    def read_at(self, index=0):
+        if self.fallback is not None:
+            return self.fallback.read_at(index)
+        readings = self._readings
+        return readings[index][1] if index < len(readings) else None
+
+    def device_count(self):
+        if self.fallback is not None:
+            return self.fallback.device_count()
+        return len(self._readings)
+
+    def close(self):
+        """Stop the child and remove the block"""
+        with self._lock:
+            self._closed = True
+            if self._process is not None and self._process.is_alive():
+                self._process.kill()
+            if self._shm is not None:
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = None
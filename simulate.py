@@ -0,0 +1,273 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from clock import VirtualClock
+from controller import Controller
+import statemachine
+
+#####################################################################################
+###  Replay a winter against the real controller on a virtual clock
+###
+###  python simulate.py                         synthetic Muskoka winter
+###  python simulate.py trace.csv               recorded temperatures
+###  python simulate.py --temp-to-constant -10 --report out.json
+###
+###  the trace is csv with a header: ts,air,water,box (ts as epoch seconds or
+###  ISO 8601 local time, a blank temperature is a failed read). The site runs
+###  with mock outputs, a null MQTT client and its savedata in a temp dir
+###  that is removed afterwards; timers, dusk/dawn and the batched savedata
+###  writes happen at their exact virtual times between samples, so two runs
+###  of the same trace give the same report. Run-hours come from the
+###  outputs' on-time metering on the virtual clock.
+#####################################################################################
+
+
+class NullClient:
+    """Stands in for the paho client, only counts publishes"""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published += 1
+
+    def subscribe(self, topics):
+        pass
+
+
+#################################################################################
+###  Temperature traces
+#################################################################################
+
+def _normals(seed):
+    """The standard normal numbers random.Random(seed).gauss() gives, for a fraction of the calls"""
+    uniform = random.Random(seed).random
+    while True:
+        angle = uniform() * 2 * math.pi
+        radius = math.sqrt(-2.0 * math.log(1.0 - uniform()))
+        yield math.cos(angle) * radius
+        yield math.sin(angle) * radius
+
+
+def synthetic_trace(start, end, step=10, seed=1):
+    """Muskoka-ish winter: seasonal curve, daily swing, multi-day weather and sensor noise"""
+    normal = _normals(seed).__next__
+    cos, tau = math.cos, 2 * math.pi
+    weather = 0.0
+    # AR(1) weather anomaly with ~3 day correlation and ~5 deg C spread
+    keep = math.exp(-step / (3 * 86400))
+    kick = 5.0 * math.sqrt(1 - keep * keep)
+    ts = start
+    hour_end = ts
+    while ts < end:
+        if ts >= hour_end:
+            # localtime() is the slow part, so only call it once per hour
+            lt = time.localtime(ts)
+            hour_start = ts - lt.tm_min * 60 - lt.tm_sec - ts % 1
+            hour_end = hour_start + 3600
+            season = 3.5 - 15.5 * cos(tau * (lt.tm_yday - 20) / 365)
+            water_mean = max(0.5, min(4.0, 2.0 + season / 10))
+        hour = lt.tm_hour + (ts - hour_start) / 3600
+        daily = 4.0 * cos(tau * (hour - 15) / 24)
+        weather = weather * keep + normal() * kick
+        air = season + daily + weather + normal() * 0.1
+        water = water_mean + normal() * 0.05
+        box = air + 5.0 + normal() * 0.1
+        yield ts, round(air, 3), round(water, 3), round(box, 3)
+        ts += step
+
+
+def _parse_ts(text):
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+def _parse_temp(text):
+    return float(text) if text.strip() else None
+
+def csv_trace(path):
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            yield (_parse_ts(row["ts"]), _parse_temp(row["air"]),
+                   _parse_temp(row.get("water", "")), _parse_temp(row.get("box", "")))
+
+
+#################################################################################
+###  The simulation
+#################################################################################
+
+def simulate(trace, settings=None, master=1, auto_bubble=1):
+    """Run one site over a trace, return a report dict"""
+    with tempfile.TemporaryDirectory(prefix="bubbler-sim-") as workdir:
+        return _simulate(workdir, trace, settings, master, auto_bubble)
+
+
+def _simulate(workdir, trace, settings, master, auto_bubble):
+    trace = iter(trace)
+    first = next(trace)
+    clock = VirtualClock(first[0])
+
+    savefile = os.path.join(workdir, "savedata.json")
+    with open(savefile, "w") as f:
+        json.dump({"mainkey": master, "autokey": auto_bubble}, f)
+
+    client = NullClient()
+    ctl = Controller(client, "sim", clock=clock)
+    # no event or temperature log unless asked for
+    site = ctl.add_site("sim", **dict({"eventlog": None, "templog": None}, **(settings or {}), backend="mock",
+                                      savefile=savefile, suntable=os.path.join(workdir, "suntable.bin")))
+    # savedata writes are counted here on the virtual clock, not made by the
+    # real-time writer thread
+    store = site.store
+    store.background = False
+    store.dry_run = True
+
+    transitions = []
+    state_seconds = dict.fromkeys(statemachine.STATE_NAMES, 0.0)
+    state_since = clock.time()
+
+    # ctl.next_due(), kept until the timers can have changed: after they ran,
+    # or a state change started or stopped some
+    due = None
+
+    def note_state(old):
+        nonlocal state_since, due
+        if site.state != old:
+            now = clock.time()
+            state_seconds[old] += now - state_since
+            state_since = now
+            transitions.append((now, old, site.state))
+            due = ctl.next_due()
+
+    def advance(ts):
+        """Run every timer, dusk/dawn boundary and savedata write up to ts at its own time"""
+        nonlocal due
+        while True:
+            write = store.due
+            if write is not None and write <= ts and (due is None or write <= due):
+                clock.set(max(write, clock.time()))
+                store.flush()
+                continue
+            if due is None or due > ts:
+                break
+            clock.set(max(due, clock.time()))
+            ctl.run_timers()
+            due = ctl.next_due()
+        clock.set(ts)
+
+    def feed(sample):
+        ts, air, water, box = sample
+        advance(ts)
+        site.record(ts, air, water, box)
+        while not ctl.q.empty():
+            old = site.state
+            ctl.dispatch(*ctl.q.get_nowait())
+            note_state(old)
+
+    wall = time.perf_counter()
+    samples = 1
+    site.record(*first)
+    old = site.state
+    ctl.start()
+    note_state(old)
+    due = ctl.next_due()
+    for sample in trace:
+        feed(sample)
+        samples += 1
+    wall = time.perf_counter() - wall
+
+    end = clock.time()
+    state_seconds[site.state] += end - state_since
+    store.flush()
+    ctl.flush_events()
+
+    return {
+        "start": datetime.fromtimestamp(first[0]).isoformat(),
+        "end": datetime.fromtimestamp(end).isoformat(),
+        "samples": samples,
+        "wall_seconds": round(wall, 2),
+        "samples_per_second": round(samples / wall) if wall else None,
+        "transitions": [
+            {"at": datetime.fromtimestamp(ts).isoformat(timespec="seconds"),
+             "from": statemachine.STATE_NAMES[a], "to": statemachine.STATE_NAMES[b]}
+            for ts, a, b in transitions],
+        "constant_entries": sum(1 for _, _, b in transitions if b == statemachine.CONSTANT),
+        "state_hours": {statemachine.STATE_NAMES[s]: round(v / 3600, 1) for s, v in state_seconds.items()},
+        "run_hours": {
+            "bubbler_1": round(site.bubbler_1.on_seconds() / 3600, 1),
+            "bubbler_2": round(site.bubbler_2.on_seconds() / 3600, 1),
+            "danger_lights": round(site.danger.on_seconds() / 3600, 1),
+        },
+        "switch_cycles": {
+            "bubbler_1": site.bubbler_1.switches,
+            "bubbler_2": site.bubbler_2.switches,
+        },
+        "mqtt_publishes": client.published,
+        "savedata_writes": site.store.writes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a temperature trace through the bubbler controller")
+    parser.add_argument("trace", nargs="?", help="csv trace (ts,air,water,box), default a synthetic winter")
+    parser.add_argument("--start", default="2025-11-01", help="synthetic trace start date")
+    parser.add_argument("--end", default="2026-05-01", help="synthetic trace end date")
+    parser.add_argument("--step", type=float, default=10, help="synthetic trace resolution (s)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--temp-to-nightly", type=float)
+    parser.add_argument("--temp-from-nightly", type=float)
+    parser.add_argument("--temp-to-constant", type=float)
+    parser.add_argument("--temp-from-constant", type=float)
+    parser.add_argument("--median", type=int, help="filter: median window (readings)")
+    parser.add_argument("--ema", type=float, help="filter: EMA time constant (s)")
+    parser.add_argument("--dwell", type=float, help="filter: secs across a threshold before it counts")
+    parser.add_argument("--eventlog", help="write the site's event log here (see season.py)")
+    parser.add_argument("--templog", help="write the site's temperature log to this directory")
+    parser.add_argument("--report", help="write the full report as json here")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+    if args.trace:
+        trace = csv_trace(args.trace)
+    else:
+        trace = synthetic_trace(datetime.fromisoformat(args.start).timestamp(),
+                                datetime.fromisoformat(args.end).timestamp(),
+                                args.step, args.seed)
+
+    settings = {}
+    for key in ("temp_to_nightly", "temp_from_nightly", "temp_to_constant", "temp_from_constant"):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    filtering = {key: getattr(args, key) for key in ("median", "ema", "dwell") if getattr(args, key) is not None}
+    if filtering:
+        settings["filter"] = filtering
+    for key in ("eventlog", "templog"):
+        if getattr(args, key):
+            settings[key] = getattr(args, key)
+
+    report = simulate(trace, settings)
+
+    print(f"{report['start']} .. {report['end']}: {report['samples']} samples "
+          f"in {report['wall_seconds']} s ({report['samples_per_second']}/s)")
+    print(f"transitions: {len(report['transitions'])}, CONSTANT entered {report['constant_entries']} times")
+    print("hours per state:", report["state_hours"])
+    print("run hours:", report["run_hours"])
+    print("switch cycles:", report["switch_cycles"])
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import metrics
+
+#####################################################################################
+###  Store-and-forward buffer for telemetry while the broker is unreachable
+###
+###  - a fixed size file, memory mapped, used as a ring of records
+###    (time, topic, payload). RAM use doesn't grow with the outage and the
+###    records survive a restart.
+###  - when full the oldest records are dropped
+###  - peek() / commit() so records are only dropped from the ring once they
+###    have been handed to the client
+###  - timeseries() turns a batch of records into one json message per topic:
+###    {"ts": [...], "<key>": [...], ...} on <topic>/history
+###
+###  positions in the header only ever grow, the place in the file is
+###  position % size, so head == tail is empty and tail - head is the bytes used
+#####################################################################################
+
+MAGIC = b"SPL1"
+HEADER = struct.Struct("<4sIQQ")    # magic, data size, head, tail
+RECORD = struct.Struct("<IdH")      # record length, time, topic length
+PAD = 0xFFFFFFFF                    # rest of the file up to the end is unused
+
+
+class Spool:
+
+    def __init__(self, path, size=1_000_000):
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) != HEADER.size + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if new:
+                os.ftruncate(fd, HEADER.size + size)
+            self._map = mmap.mmap(fd, HEADER.size + size)
+        finally:
+            os.close(fd)
+        magic, stored_size, self.head, self.tail = HEADER.unpack_from(self._map, 0)
+        if new or magic != MAGIC or stored_size != size or not 0 <= self.tail - self.head <= size:
+            if not new:
+                logging.warning("spool %s unusable, starting empty", path)
+            self.head = self.tail = 0
+            self._write_header()
+        elif self.tail != self.head:
+            logging.info("spool %s holds %d bytes from before the restart", path, self.tail - self.head)
+
+        self.dropped = metrics.counter("bubbler_spool_dropped_total", "spooled records dropped, spool full")
+        metrics.gauge("bubbler_spool_bytes", "bytes of telemetry waiting in the spool", fn=lambda: self.tail - self.head)
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, self.size, self.head, self.tail)
+
+    def _record_at(self, pos):
+        """(length in the ring, time, topic, payload) of the record at pos, time None for padding"""
+        offset = pos % self.size
+        room = self.size - offset
+        if room < RECORD.size:
+            return room, None, None, None
+        length, ts, topic_len = RECORD.unpack_from(self._map, HEADER.size + offset)
+        if length == PAD:
+            return room, None, None, None
+        start = HEADER.size + offset + RECORD.size
+        topic = self._map[start:start + topic_len].decode()
+        payload = self._map[start + topic_len:HEADER.size + offset + length]
+        return length, ts, topic, payload
+
+    def _drop_oldest(self):
+        length, ts, _, _ = self._record_at(self.head)
+        self.head += length
+        if ts is not None:
+            self.dropped.inc()
+
+    def append(self, ts, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        length = RECORD.size + len(topic) + len(payload)
+        if length > self.size // 4:
+            logging.warning("not spooling %d byte message on %s", length, topic)
+            return
+        with self._lock:
+            room = self.size - self.tail % self.size
+            pad = room if room < length else 0
+            while self.size - (self.tail - self.head) < pad + length:
+                self._drop_oldest()
+            if pad:
+                if pad >= RECORD.size:
+                    RECORD.pack_into(self._map, HEADER.size + self.tail % self.size, PAD, 0.0, 0)
+                self.tail += pad
+            offset = HEADER.size + self.tail % self.size
+            RECORD.pack_into(self._map, offset, length, ts, len(topic))
+            self._map[offset + RECORD.size:offset + length] = topic + payload
+            self.tail += length
+            self._write_header()
+
+    def peek(self, n):
+        """Up to n of the oldest records as [(time, topic, payload)], and the position to commit"""
+        records = []
+        with self._lock:
+            pos = self.head
+            while pos < self.tail and len(records) < n:
+                length, ts, topic, payload = self._record_at(pos)
+                pos += length
+                if ts is not None:
+                    records.append((ts, topic, payload))
+        return records, pos
+
+    def commit(self, pos):
+        """Forget everything before pos, the records peek() returned have been sent"""
+        with self._lock:
+            if self.head < pos <= self.tail:
+                self.head = pos
+                self._write_header()
+
+    def flush(self):
+        """Push the ring to the card, the kernel does it by itself within ~30s anyway"""
+        with self._lock:
+            self._map.flush()
+
+
+def timeseries(records):
+    """[(topic, json payload), ...], one per topic, for a batch of spooled readings"""
+    series = {}
+    for ts, topic, payload in records:
+        values = json.loads(payload)
+        columns = series.setdefault(topic, {"ts": []})
+        n = len(columns["ts"])
+        columns["ts"].append(round(ts, 1))
+        for key, value in values.items():
+            columns.setdefault(key, [None] * n).append(value)
+        for column in columns.values():
+            if len(column) == n:
+                column.append(None)      # key missing from this record
+    return [(f"{topic}/history", json.dumps(columns, separators=(",", ":")))
+            for topic, columns in series.items()]
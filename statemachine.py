@@ -0,0 +1,141 @@
+from eventlog import STATE
+
+#####################################################################################
+###  Table driven state machine for a site
+###
+###  - TRANSITIONS lists every exit of every state with the event that can make
+###    its guard true: "cmd" (bubbler_main / auto_bubble changed) or "temp"
+###    (new air temperature)
+###  - compile_table() turns it into a dict keyed by (state, event) once at import,
+###    so step() only evaluates the guards that can have changed
+###  - guards are checked in table order and the first one that passes wins,
+###    master power off beats auto_bubble off beats temperature
+###  - the exit actions of the old state run before the entry actions of the new
+#####################################################################################
+
+OFF = 0
+IDLE = 1
+NIGHTLY = 2
+CONSTANT = 3
+
+STATE_NAMES = {OFF: "Off", IDLE: "Idle", NIGHTLY: "Nightly", CONSTANT: "Constant"}
+
+EVENTS = ("cmd", "temp")
+
+
+def below(temp, limit):
+    # no reading (failed sensor) never triggers a transition
+    return temp is not None and temp < limit
+
+def above(temp, limit):
+    return temp is not None and temp > limit
+
+
+#################################################################################
+### the transitions: (from, to, event or events, guard)
+#################################################################################
+
+TRANSITIONS = [
+### OFF: bubbler_main turns on
+    (OFF,      IDLE,     "cmd",  lambda s: s.master == 1),
+
+### IDLE: bubbler_main turns off, or auto_bubble on and air temp below 0
+    (IDLE,     OFF,      "cmd",  lambda s: s.master == 0),
+    (IDLE,     NIGHTLY,  ("cmd", "temp"), lambda s: s.auto_bubble == 1 and below(s.air_temp_loop, s.temp_to_nightly)),
+
+### NIGHTLY: bubbler_main off, auto_bubble off, temp drops below -8 or goes above 1
+    (NIGHTLY,  OFF,      "cmd",  lambda s: s.master == 0),
+    (NIGHTLY,  IDLE,     "cmd",  lambda s: s.auto_bubble == 0),
+    (NIGHTLY,  CONSTANT, "temp", lambda s: below(s.air_temp_loop, s.temp_to_constant)),
+    (NIGHTLY,  IDLE,     "temp", lambda s: above(s.air_temp_loop, s.temp_from_nightly)),
+
+### CONSTANT: bubbler_main off, auto_bubble off, temp goes above -6
+    (CONSTANT, OFF,      "cmd",  lambda s: s.master == 0),
+    (CONSTANT, IDLE,     "cmd",  lambda s: s.auto_bubble == 0),
+    (CONSTANT, NIGHTLY,  "temp", lambda s: above(s.air_temp_loop, s.temp_from_constant)),
+]
+
+
+#################################################################################
+### entry and exit actions
+#################################################################################
+
+def enter_off(site):
+    site.pub.publish(f"{site.name}/state/bubbler_main","OFF", qos=1, retain=True)
+    site.pub.publish(f"{site.name}/state/statemachine","Off", qos=1, retain=True)
+    site.auto_bubble = 0
+    site.pub.publish(f"{site.name}/state/auto_bubble","OFF", qos=1, retain=True)
+
+def enter_idle(site):
+    site.pub.publish(f"{site.name}/state/bubbler_main","ON", qos=1, retain=True)
+    site.pub.publish(f"{site.name}/state/statemachine","Idle", qos=1, retain=True)
+
+def enter_nightly(site):
+    site.pub.publish(f"{site.name}/state/statemachine","Nightly", qos=1, retain=True)
+    site.start_nightly()
+
+def leave_nightly(site):
+    site.stop_nightly()
+    site.bubbler_1_off()
+    site.bubbler_2_off()
+
+def enter_constant(site):
+    site.pub.publish(f"{site.name}/state/statemachine","Constant", qos=1, retain=True)
+    site.start_constant()
+
+def leave_constant(site):
+    site.stop_constant()
+    site.bubbler_1_off()
+    site.bubbler_2_off()
+
+ON_ENTRY = {OFF: enter_off, IDLE: enter_idle, NIGHTLY: enter_nightly, CONSTANT: enter_constant}
+ON_EXIT = {NIGHTLY: leave_nightly, CONSTANT: leave_constant}
+
+
+def compile_table(transitions):
+    """{(state, event): [(guard, to), ...]} plus the same for every event at once"""
+    table = {}
+    for state in STATE_NAMES:
+        for event in EVENTS + ("any",):
+            table[(state, event)] = []
+    for state, to, events, guard in transitions:
+        if isinstance(events, str):
+            events = (events,)
+        if state not in STATE_NAMES or to not in STATE_NAMES or not set(events) <= set(EVENTS):
+            raise ValueError(f"bad transition {state} -> {to} on {events}")
+        for event in events:
+            table[(state, event)].append((guard, to))
+        table[(state, "any")].append((guard, to))
+    return table
+
+TABLE = compile_table(TRANSITIONS)
+
+
+def step(site, event="any"):
+    """Run the transitions an event can trigger. Returns True if the state changed.
+
+    After a transition every guard of the new state is checked, since the new
+    state may already be due to move on (e.g. IDLE -> NIGHTLY -> CONSTANT
+    when auto_bubble is turned on at -10).
+    """
+    changed = False
+    for _ in range(len(STATE_NAMES)):
+        for guard, to in TABLE[(site.state, event)]:
+            if guard(site):
+                break
+        else:
+            return changed
+
+        old = site.state
+        site.log.debug("entering state %s from state %s", to, old)
+        if old in ON_EXIT:
+            ON_EXIT[old](site)
+        site.state = to
+        site.log_event(STATE, to)
+        ON_ENTRY[to](site)
+        site.savedata()
+        changed = True
+        event = "any"
+
+    site.log.warning("state machine did not settle, stopped in state %s", site.state)
+    return changed
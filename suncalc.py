@@ -1,33 +1,18 @@
 import time
-from datetime import datetime
-from datetime import date
-import pytz
-from suntime import Sun
-import schedule
+from ephemeris import SunTable
 
 
-def calcsun():
-    latitude = 45.08608
-    longitude = -79.552073
-    tz_muskoka = pytz.timezone('America/Toronto')
-    sun = Sun(latitude, longitude)
-    now = datetime.now()
-    global today_sr
-    today_sr = sun.get_sunrise_time(now).astimezone(tz_muskoka).strftime("%H:%M")
-    global today_ss
-    today_ss = sun.get_sunset_time(now).astimezone(tz_muskoka).strftime("%H:%M")
-    ct = now.strftime("%H:%M")
-    cd = date.today()
-    print("Running calcsun at ", cd, ct)
-    print("new sunrise time:", today_sr)
-    print("new sunset time:", today_ss)
+### print today's sunrise/sunset from the cached table, building it if needed
 
+latitude = 45.08608
+longitude = -79.552073
 
-### schedule to calcualte new sunrise/sunset every night
-schedule.every().hour.do(calcsun)
+sun = SunTable.load('suntable.bin', latitude, longitude)
 
-calcsun()
-
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+now = time.time()
+today_sr, today_ss = sun.today(now)
+print("Running suncalc at ", time.strftime("%Y-%m-%d %H:%M", time.localtime(now)))
+print("sunrise time:", time.strftime("%H:%M", time.localtime(today_sr)))
+print("sunset time:", time.strftime("%H:%M", time.localtime(today_ss)))
+print("dark now:", sun.is_dark(now))
+print("minutes to next dusk/dawn:", sun.minutes_to_next(now))
@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import pytest
+
+from control import ControlServer
+
+
+@pytest.mark.parametrize("line", [
+    '{"site": ["a"]}',
+    '{"site": {"cust1": 1}}',
+    '{"cmd": "bubbler_1"}',
+    '{"site": "cust1", "cmd": 1}',
+    '{"site": "cust1", "cmd": ["bubbler_1"]}',
+    '{not json',
+    '   ',
+])
+def test_bad_request(line):
+    server = ControlServer(SimpleNamespace(sites={}))
+    assert server.handle(line)["error"].startswith("bad request: ")
+
+
+def test_no_site():
+    server = ControlServer(SimpleNamespace(sites={}))
+    assert server.handle('{"site": "cust1"}') == {"error": "no site cust1"}
+    assert server.handle("cust1 bubbler_1 ON") == {"error": "no site cust1"}
@@ -0,0 +1,69 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from clock import VirtualClock
+from controller import Controller
+
+START = 1767000000.0
+
+
+class MockClient:
+
+    def __init__(self):
+        self.sent = []
+        self.subscribed = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.sent.append((topic, payload))
+        return SimpleNamespace(rc=0)
+
+    def subscribe(self, topics):
+        self.subscribed.extend(topic for topic, qos in topics)
+
+
+@pytest.fixture
+def controller():
+    return Controller(MockClient(), "gw", clock=VirtualClock(START))
+
+
+def add_site(controller, tmp_path, name, **settings):
+    defaults = {"backend": "mock", "savefile": str(tmp_path / "savedata-{site}.json"),
+                "suntable": str(tmp_path / "suntable.bin"), "eventlog": None, "templog": None}
+    return controller.add_site(name, **dict(defaults, **settings))
+
+
+def test_sites_keep_their_own_savedata(controller, tmp_path):
+    a = add_site(controller, tmp_path, "dockA")
+    b = add_site(controller, tmp_path, "dockB")
+    assert a.store.path != b.store.path
+    assert a.sun is b.sun
+    with pytest.raises(ValueError, match="already used by site dockA"):
+        add_site(controller, tmp_path, "dockC", savefile=a.store.path)
+
+
+def test_remote_readings(controller, tmp_path):
+    site = add_site(controller, tmp_path, "dock", sensors="mqtt")
+    controller.on_connect(controller.client, None, None, 0, None)
+    assert "dock/sensors/temperatures" in controller.client.subscribed
+
+    def reading(payload):
+        message = SimpleNamespace(topic="dock/sensors/temperatures", payload=json.dumps(payload).encode())
+        controller.on_message(controller.client, None, message)
+
+    reading({"airtemp": -3.5, "watertemp": 1.25, "boxtemp": 5, "ts": START - 2})
+    assert (site.history.latest("air"), site.history.latest("water")) == (-3.5, 1.25)
+    assert controller.q.get_nowait()[1] == "temp"
+    # the same reading again (a retained message) changes nothing
+    reading({"airtemp": -3.5, "ts": START - 2})
+    assert site.history.latest("water") == 1.25 and controller.q.empty()
+    # junk is dropped
+    reading(["no"])
+    reading({"airtemp": "cold"})
+    assert site.history.latest("air") == -3.5
+
+
+def test_gpiohost_needs_gpiozero(controller, tmp_path):
+    with pytest.raises(ValueError, match="gpiohost"):
+        add_site(controller, tmp_path, "dock", gpiohost="dock-pi")
@@ -0,0 +1,63 @@
+import io
+import os
+
+import pytest
+
+import ds18b20
+from ds18b20 import DS18B20, w1_slave_text
+
+TEMPS = {"28-000000000000": 4.5, "28-000000000001": -1.25, "28-000000000002": 12.0}
+
+
+@pytest.fixture
+def w1(tmp_path):
+    """A fake /sys/bus/w1/devices with one bus master and a sensor per TEMPS"""
+    os.makedirs(tmp_path / "w1_bus_master1")
+    (tmp_path / "w1_bus_master1" / "therm_bulk_read").write_text("1\n")
+    for name, temp in TEMPS.items():
+        os.makedirs(tmp_path / name)
+        (tmp_path / name / "w1_slave").write_text(w1_slave_text(temp))
+    return tmp_path
+
+
+def readings(sensors):
+    """sensor id -> reading, discover() finds them in no particular order"""
+    return {s.id: sensors.tempC(i) for i, s in enumerate(sensors._sensors)}
+
+
+def test_bulk_read(w1):
+    sensors = DS18B20(str(w1) + "/")
+    assert sensors.device_count() == len(TEMPS)
+    assert sensors._bulk_convert()
+    assert (w1 / "w1_bus_master1" / "therm_bulk_read").read_text() == "trigger\n"
+    sensors.sweep()
+    assert readings(sensors) == TEMPS
+    assert sensors._bulk
+
+
+def test_bulk_read_timeout(w1, monkeypatch):
+    # the master keeps reporting -1, the conversion never finishes
+    def fake_open(path, mode="r", *args, **kwargs):
+        if str(path).endswith("therm_bulk_read") and "r" in mode:
+            return io.StringIO("-1\n")
+        return open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(ds18b20, "open", fake_open, raising=False)
+    monkeypatch.setattr(DS18B20, "bulk_timeout", 0.2)
+    sensors = DS18B20(str(w1) + "/")
+    assert not sensors._bulk_convert()
+    # the sensors are still read one at a time, and the next sweep tries the bulk read again
+    sensors.sweep()
+    assert readings(sensors) == TEMPS
+    assert sensors._bulk
+
+
+def test_bulk_read_not_available(w1):
+    # a therm_bulk_read that can't be written, the bulk read is given up on
+    os.remove(w1 / "w1_bus_master1" / "therm_bulk_read")
+    os.makedirs(w1 / "w1_bus_master1" / "therm_bulk_read")
+    sensors = DS18B20(str(w1) + "/")
+    assert sensors._bulk_file
+    sensors.sweep()
+    assert not sensors._bulk
+    assert readings(sensors) == TEMPS
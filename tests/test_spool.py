@@ -0,0 +1,95 @@
+import json
+import random
+
+import pytest
+
+from spool import RECORD, Spool, timeseries
+
+
+def drain(spool):
+    records, _ = spool.peek(len(spool) + 1)
+    return records
+
+
+def test_append_peek_commit(tmp_path):
+    spool = Spool(str(tmp_path / "spool.bin"), size=1000)
+    for i in range(5):
+        spool.append(float(i), "dock/state/temperatures", json.dumps({"airtemp": i}))
+    records, end = spool.peek(3)
+    assert [ts for ts, _, _ in records] == [0.0, 1.0, 2.0]
+    spool.commit(end)
+    assert [ts for ts, _, _ in drain(spool)] == [3.0, 4.0]
+    # a stale position from before is ignored
+    spool.commit(end)
+    assert len(drain(spool)) == 2
+
+
+def test_too_big_is_not_spooled(tmp_path):
+    spool = Spool(str(tmp_path / "spool.bin"), size=1000)
+    spool.append(0.0, "t", "x" * 300)
+    assert len(spool) == 0
+
+
+def test_bad_file_starts_empty(tmp_path):
+    path = tmp_path / "spool.bin"
+    spool = Spool(str(path), size=1000)
+    spool.append(0.0, "t", "{}")
+    spool.flush()
+    data = bytearray(path.read_bytes())
+    data[:4] = b"XXXX"
+    path.write_bytes(bytes(data))
+    assert len(Spool(str(path), size=1000)) == 0
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random(tmp_path, seed):
+    """Against a list of what was appended and not yet committed: the spool holds
+    the newest of those in order, drops only the oldest and only when full, and
+    comes back the same after a reopen"""
+    rng = random.Random(seed)
+    path = str(tmp_path / "spool.bin")
+    size = rng.choice([257, 1000, 4096])
+    spool = Spool(path, size=size)
+    expected = []
+    n = 0
+    for _ in range(3000):
+        op = rng.random()
+        if op < 0.6:
+            topic = f"dock{rng.randrange(3)}/state/temperatures"
+            payload = json.dumps({"airtemp": n, "pad": "x" * rng.randrange(size // 5)})
+            length = RECORD.size + len(topic) + len(payload)
+            if length > size // 4:
+                continue
+            dropped, used = spool.dropped.get(), len(spool)
+            spool.append(float(n), topic, payload)
+            expected.append((float(n), topic, payload.encode()))
+            n += 1
+            held = drain(spool)
+            lost = len(expected) - len(held)
+            assert held == expected[lost:]
+            assert spool.dropped.get() - dropped == lost
+            expected = expected[lost:]
+            if lost:
+                # only when full: the padding to the end of the file is less than one record
+                assert used + 2 * length > size
+        elif op < 0.9:
+            records, end = spool.peek(rng.randrange(1, 10))
+            assert records == expected[:len(records)]
+            if rng.random() < 0.8:
+                spool.commit(end)
+                expected = expected[len(records):]
+        else:
+            spool.flush()
+            spool = Spool(path, size=size)
+        assert drain(spool) == expected
+        assert 0 <= len(spool) <= size
+
+
+def test_timeseries():
+    records = [(1.0, "a/state/temperatures", b'{"airtemp": 1, "watertemp": 2}'),
+               (2.0, "a/state/temperatures", b'{"airtemp": 3}'),
+               (2.0, "b/state/temperatures", b'{"boxtemp": 4}')]
+    assert dict(timeseries(records)) == {
+        "a/state/temperatures/history": '{"ts":[1.0,2.0],"airtemp":[1,3],"watertemp":[2,null]}',
+        "b/state/temperatures/history": '{"ts":[2.0],"boxtemp":[4]}',
+    }
@@ -0,0 +1,142 @@
+import logging
+
+import pytest
+
+import statemachine
+from statemachine import OFF, IDLE, NIGHTLY, CONSTANT
+
+
+class MockPublisher:
+
+    def __init__(self):
+        self.sent = {}
+
+    def publish(self, topic, payload=None, qos=0, retain=False, force=False):
+        self.sent[topic] = payload
+
+
+class MockSite:
+    """What the state machine uses of a Site, with a record of the actions it ran"""
+
+    def __init__(self, state=OFF, master=0, auto_bubble=0, air=None):
+        self.name = "dock"
+        self.state = state
+        self.master = master
+        self.auto_bubble = auto_bubble
+        self.air_temp_loop = air
+        self.temp_to_nightly = 0
+        self.temp_from_nightly = 1
+        self.temp_to_constant = -8
+        self.temp_from_constant = -6
+        self.pub = MockPublisher()
+        self.log = logging.getLogger("test")
+        self.actions = []
+        self.states = []
+
+    def log_event(self, kind, value):
+        self.states.append(value)
+
+    def savedata(self):
+        pass
+
+    def __getattr__(self, name):
+        # start_nightly, stop_constant, bubbler_1_off, ...
+        if name.startswith(("start_", "stop_", "bubbler_")):
+            return lambda: self.actions.append(name)
+        raise AttributeError(name)
+
+
+def test_off_to_idle():
+    site = MockSite()
+    assert not statemachine.step(site, "cmd")
+    site.master = 1
+    assert statemachine.step(site, "cmd")
+    assert site.state == IDLE
+    assert site.pub.sent["dock/state/statemachine"] == "Idle"
+    assert site.pub.sent["dock/state/bubbler_main"] == "ON"
+
+
+def test_idle_to_nightly_needs_auto_bubble():
+    site = MockSite(IDLE, master=1, air=-2)
+    assert not statemachine.step(site, "temp")
+    site.auto_bubble = 1
+    assert statemachine.step(site, "cmd")
+    assert site.state == NIGHTLY
+    assert site.actions == ["start_nightly"]
+
+
+def test_nightly_and_constant_by_temperature():
+    site = MockSite(IDLE, master=1, auto_bubble=1, air=-1)
+    statemachine.step(site, "temp")
+    assert site.state == NIGHTLY
+    site.air_temp_loop = -9
+    statemachine.step(site, "temp")
+    assert site.state == CONSTANT
+    # between the thresholds nothing moves
+    site.air_temp_loop = -7
+    assert not statemachine.step(site, "temp")
+    site.air_temp_loop = -5
+    statemachine.step(site, "temp")
+    assert site.state == NIGHTLY
+    site.air_temp_loop = 2
+    statemachine.step(site, "temp")
+    assert site.state == IDLE
+    assert site.states == [NIGHTLY, CONSTANT, NIGHTLY, IDLE]
+    assert site.actions == ["start_nightly",
+                            "stop_nightly", "bubbler_1_off", "bubbler_2_off", "start_constant",
+                            "stop_constant", "bubbler_1_off", "bubbler_2_off", "start_nightly",
+                            "stop_nightly", "bubbler_1_off", "bubbler_2_off"]
+
+
+def test_chained_transitions():
+    # auto_bubble turned on at -10: IDLE -> NIGHTLY -> CONSTANT in one step
+    site = MockSite(IDLE, master=1, auto_bubble=1, air=-10)
+    assert statemachine.step(site, "cmd")
+    assert site.state == CONSTANT
+    assert site.states == [NIGHTLY, CONSTANT]
+    assert site.actions == ["start_nightly", "stop_nightly", "bubbler_1_off", "bubbler_2_off", "start_constant"]
+
+
+def test_off_from_boot_goes_all_the_way():
+    site = MockSite(OFF, master=1, auto_bubble=1, air=-10)
+    statemachine.step(site)
+    assert site.states == [IDLE, NIGHTLY, CONSTANT]
+
+
+@pytest.mark.parametrize("state", [IDLE, NIGHTLY, CONSTANT])
+def test_master_off_beats_everything(state):
+    # auto_bubble off and a temperature exit are due too, master off wins
+    site = MockSite(state, master=0, auto_bubble=0, air=5)
+    assert statemachine.step(site)
+    assert site.state == OFF
+    assert site.states == [OFF]
+    assert site.pub.sent["dock/state/statemachine"] == "Off"
+    assert site.pub.sent["dock/state/auto_bubble"] == "OFF"
+
+
+@pytest.mark.parametrize("state, air", [(NIGHTLY, -10), (CONSTANT, 5)])
+def test_auto_bubble_off_beats_temperature(state, air):
+    site = MockSite(state, master=1, auto_bubble=0, air=air)
+    statemachine.step(site)
+    assert site.states == [IDLE]
+    assert "start_constant" not in site.actions and "start_nightly" not in site.actions
+
+
+def test_cmd_event_skips_temperature_guards():
+    site = MockSite(NIGHTLY, master=1, auto_bubble=1, air=-10)
+    assert not statemachine.step(site, "cmd")
+    assert site.state == NIGHTLY
+
+
+@pytest.mark.parametrize("state", [IDLE, NIGHTLY, CONSTANT])
+def test_no_reading_no_transition(state):
+    site = MockSite(state, master=1, auto_bubble=1, air=None)
+    assert not statemachine.step(site, "temp")
+    assert site.state == state
+
+
+def test_bad_table():
+    with pytest.raises(ValueError):
+        statemachine.compile_table([(OFF, 7, "cmd", lambda s: True)])
+    with pytest.raises(ValueError):
+        statemachine.compile_table([(OFF, IDLE, "tick", lambda s: True)])
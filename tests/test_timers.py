@@ -0,0 +1,118 @@
+import time
+
+from clock import VirtualClock
+from timers import Scheduler, next_daily
+
+START = time.mktime((2026, 1, 10, 12, 0, 0, 0, 0, -1))
+
+
+class JumpClock(VirtualClock):
+    """A virtual clock whose wall time can be set apart from its monotonic time, as NTP does"""
+
+    def __init__(self, start):
+        super().__init__(start)
+        self.jump = 0.0
+
+    def time(self):
+        return self.now + self.jump
+
+
+def advance(scheduler, clock, seconds, step=1.0):
+    """Move the clock on, running the timers as the main loop would"""
+    end = clock.now + seconds
+    while clock.now < end:
+        clock.set(min(clock.now + step, end))
+        scheduler.run_pending()
+
+
+def test_interval_catches_up():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.every(10, lambda: calls.append(clock.now))
+    clock.set(START + 35)
+    scheduler.run_pending()
+    # the three missed runs, then back on the original beat
+    assert len(calls) == 3
+    assert scheduler.next_due() == START + 40
+
+
+def test_call_later_and_cancel():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.call_later(5, calls.append, "a")
+    timer = scheduler.call_later(5, calls.append, "b")
+    scheduler.call_later(6, calls.append, "c", tag="t")
+    timer.cancel()
+    scheduler.cancel("t")
+    advance(scheduler, clock, 10)
+    assert calls == ["a"]
+    assert scheduler.next_due() is None and scheduler.jobs() == []
+
+
+def test_cycle():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.cycle([(lambda: calls.append(("on", clock.now - START)), 10),
+                     (lambda: calls.append(("off", clock.now - START)), 5)], tag="c")
+    advance(scheduler, clock, 30)
+    assert calls == [("on", 0), ("off", 10), ("on", 15), ("off", 25), ("on", 30)]
+    scheduler.cancel("c")
+    advance(scheduler, clock, 30)
+    assert len(calls) == 5 and scheduler.jobs() == []
+
+
+def test_cycle_cancelled_from_its_own_step():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+
+    def stop():
+        calls.append("stop")
+        scheduler.cancel("c")
+
+    scheduler.cycle([(lambda: calls.append("run"), 10), (stop, 10)], tag="c")
+    advance(scheduler, clock, 60)
+    assert calls == ["run", "stop"]
+    assert scheduler.jobs() == [] and "c" not in scheduler._tags
+
+
+def test_cycle_cancelled_in_its_first_step():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+    cycle = scheduler.cycle([(lambda: (calls.append("run"), scheduler.cancel("c")), 10)], tag="c")
+    assert cycle.cancelled and cycle.timer is None
+    advance(scheduler, clock, 30)
+    assert calls == ["run"]
+
+
+def test_daily():
+    clock = VirtualClock(START)
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.daily("03:00", lambda: calls.append(clock.now))
+    first = next_daily(START, "03:00")
+    assert scheduler.next_due() == first
+    advance(scheduler, clock, 2 * 86400, step=60)
+    assert calls == [first, next_daily(first, "03:00")]
+
+
+def test_daily_reanchored_after_clock_jump():
+    # booted without an RTC: the wall clock is 3 hours behind until NTP sets it
+    clock = JumpClock(START)
+    clock.jump = -3 * 3600
+    scheduler = Scheduler(clock)
+    calls = []
+    scheduler.daily("03:00", lambda: calls.append(clock.time()))
+    interval = []
+    scheduler.every(600, lambda: interval.append(clock.now))
+
+    clock.set(START + 60)
+    clock.jump = 0.0
+    advance(scheduler, clock, 86400, step=60)
+    # the daily timer follows the wall clock, the interval keeps its monotonic beat
+    assert calls == [next_daily(START, "03:00")]
+    assert interval == [START + 600 * n for n in range(1, 145)]
@@ -0,0 +1,85 @@
+import threading
+
+from watchdog import Watchdog
+
+
+class FakeDevice:
+    """Counts the feeds instead of arming anything"""
+
+    def __init__(self):
+        self.fed = 0
+        self.closed = False
+
+    def feed(self):
+        self.fed += 1
+
+    def close(self):
+        self.closed = True
+
+
+def make_watchdog():
+    stalls = []
+    device = FakeDevice()
+    return Watchdog(device, on_stall=stalls.append), device, stalls
+
+
+def test_fed_while_healthy():
+    dog, device, stalls = make_watchdog()
+    ticks = [0]
+    dog.watch("main", lambda: ticks[0], limit=10, fatal=True)
+    for now in range(0, 100, 5):
+        ticks[0] += 1
+        assert dog.check(now=now) == []
+    assert device.fed == 20
+    assert not dog.tripped and stalls == []
+
+
+def test_fatal_stall():
+    dog, device, stalls = make_watchdog()
+    ticks = [0]
+    dog.watch("main", lambda: ticks[0], limit=10, fatal=True)
+    dog.check(now=0)
+    dog.check(now=5)
+    assert device.fed == 2
+
+    # no progress for more than `limit`: on_stall once, and no more feeding
+    for now in (11, 16, 21):
+        assert [w.name for w in dog.check(now=now)] == ["main"]
+    assert stalls == [["main"]]
+    assert dog.tripped and device.fed == 2
+
+    # moving again: fed again, and the next stall trips it again
+    ticks[0] += 1
+    assert dog.check(now=25) == []
+    assert not dog.tripped and device.fed == 3
+    dog.check(now=40)
+    assert stalls == [["main"], ["main"]]
+    assert device.fed == 3
+
+
+def test_stall_not_fatal():
+    dog, device, stalls = make_watchdog()
+    dog.watch("sensors", lambda: 0, limit=10)
+    dog.check(now=0)
+    assert [w.name for w in dog.check(now=20)] == ["sensors"]
+    assert stalls == [] and device.fed == 2
+
+
+def test_dead_thread():
+    dog, device, stalls = make_watchdog()
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    ticks = [0]
+    # still "moving", but the thread behind it is gone
+    dog.watch("savedata", lambda: ticks[0], thread=thread, fatal=True)
+    ticks[0] += 1
+    assert [w.name for w in dog.check(now=0)] == ["savedata"]
+    assert stalls == [["savedata"]]
+    assert device.fed == 0
+
+
+def test_stop_disarms():
+    dog, device, stalls = make_watchdog()
+    dog.stop()
+    assert device.closed
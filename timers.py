@@ -0,0 +1,174 @@
+import heapq
+import itertools
+import time
+
+#####################################################################################
+###  Timer heap shared by every site
+###
+###  - daily "HH:MM" jobs, repeating intervals, one-shot delays and cycles of
+###    timed steps in one heap, driven by a clock (clock.py)
+###  - the heap runs on the clock's monotonic time, so NTP setting the clock
+###    at boot (no RTC on a Pi) doesn't stretch or skip a relative timer. Daily
+###    timers are re-anchored to the wall clock when it jumps.
+###  - idle_seconds() gives the exact time to the next timer so the main loop
+###    can sleep until then, run_pending() only touches the timers that are due
+###  - every timer returned can be cancelled on its own, cancel(tag) drops all
+###    the timers with a tag at once
+#####################################################################################
+
+# wall clock moving this far against the monotonic clock counts as a jump
+JUMP = 1.0
+
+
+def next_daily(now, at):
+    """Epoch time of the next local "HH:MM" after now"""
+    hh, mm = (int(x) for x in at.split(":"))
+    lt = time.localtime(now)
+    due = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, hh, mm, 0, 0, 0, -1))
+    if due <= now:
+        # mktime normalizes day 32 etc. and works out DST for the new date
+        due = time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday + 1, hh, mm, 0, 0, 0, -1))
+    return due
+
+
+class Timer:
+
+    def __init__(self, fn, args, tag, interval=None, daily=None):
+        self.fn = fn
+        self.args = args
+        self.tag = tag
+        self.interval = interval        # repeat every interval seconds
+        self.daily = daily              # repeat every day at "HH:MM"
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Cycle:
+    """Handle for Scheduler.cycle(), cancels whichever step is pending"""
+
+    def __init__(self, scheduler, steps, tag):
+        self.scheduler = scheduler
+        self.steps = steps
+        self.tag = tag
+        self.timer = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.scheduler._drop(self)
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+class Scheduler:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self._heap = []                 # (monotonic due, seq, timer)
+        self._seq = itertools.count()   # keeps timers due at the same time in order
+        self._tags = {}                 # tag -> timers
+        self._offset = clock.time() - clock.monotonic()    # wall - monotonic
+
+    def _push(self, due, timer):
+        heapq.heappush(self._heap, (due, next(self._seq), timer))
+        if timer.tag is not None:
+            self._tags.setdefault(timer.tag, set()).add(timer)
+        return timer
+
+    def _daily_due(self, at, mono):
+        wall = mono + self._offset
+        return mono + next_daily(wall, at) - wall
+
+    def call_later(self, delay, fn, *args, tag=None):
+        return self._push(self.clock.monotonic() + delay, Timer(fn, args, tag))
+
+    def every(self, seconds, fn, *args, tag=None):
+        return self._push(self.clock.monotonic() + seconds, Timer(fn, args, tag, interval=seconds))
+
+    def daily(self, at, fn, *args, tag=None):
+        self._check_jump()
+        return self._push(self._daily_due(at, self.clock.monotonic()), Timer(fn, args, tag, daily=at))
+
+    def cycle(self, steps, tag=None):
+        """Run [(fn, seconds to the next step), ...] round and round until cancelled.
+
+        The first step runs now.
+        """
+        cycle = Cycle(self, list(steps), tag)
+        if tag is not None:
+            # so cancel(tag) also stops it from inside one of its own steps
+            self._tags.setdefault(tag, set()).add(cycle)
+        self._cycle_step(cycle, 0)
+        return cycle
+
+    def _cycle_step(self, cycle, i):
+        if cycle.cancelled:
+            return
+        fn, wait = cycle.steps[i]
+        fn()
+        if not cycle.cancelled:
+            cycle.timer = self.call_later(wait, self._cycle_step, cycle, (i + 1) % len(cycle.steps), tag=cycle.tag)
+
+    def cancel(self, tag):
+        for timer in self._tags.pop(tag, ()):
+            timer.cancel()
+
+    def _drop(self, timer):
+        timer.cancelled = True
+        if timer.tag is not None:
+            timers = self._tags.get(timer.tag)
+            if timers is not None:
+                timers.discard(timer)
+                if not timers:
+                    del self._tags[timer.tag]
+
+    def _check_jump(self):
+        """Re-anchor the daily timers if the wall clock was set, returns wall - monotonic now"""
+        offset = self.clock.time() - self.clock.monotonic()
+        if abs(offset - self._offset) < JUMP:
+            return offset
+        self._offset = offset
+        now = self.clock.monotonic()
+        self._heap = [(self._daily_due(timer.daily, now) if timer.daily else due, seq, timer)
+                      for due, seq, timer in self._heap if not timer.cancelled]
+        heapq.heapify(self._heap)
+        return offset
+
+    def _skip_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            self._drop(heapq.heappop(self._heap)[2])
+
+    def idle_seconds(self):
+        """Seconds until the next timer, None if there are none"""
+        self._check_jump()
+        self._skip_cancelled()
+        if not self._heap:
+            return None
+        return self._heap[0][0] - self.clock.monotonic()
+
+    def next_due(self):
+        """Epoch time of the next timer, None if there are none"""
+        offset = self._check_jump()
+        self._skip_cancelled()
+        return self._heap[0][0] + offset if self._heap else None
+
+    def run_pending(self):
+        self._check_jump()
+        now = self.clock.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            due, _, timer = self._heap[0]
+            # a repeating timer is rescheduled in place, one sift instead of a pop and a push
+            if timer.cancelled:
+                self._drop(heapq.heappop(self._heap)[2])
+                continue
+            if timer.interval is not None:
+                heapq.heapreplace(self._heap, (due + timer.interval, next(self._seq), timer))
+            elif timer.daily is not None:
+                heapq.heapreplace(self._heap, (self._daily_due(timer.daily, due), next(self._seq), timer))
+            else:
+                self._drop(heapq.heappop(self._heap)[2])
+            timer.fn(*timer.args)
+
+    def jobs(self):
+        return [timer for _, _, timer in self._heap if not timer.cancelled]
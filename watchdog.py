@@ -0,0 +1,172 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+#####################################################################################
+###  Watchdog for the main loop and the worker threads
+###
+###  - everything watched gives a progress() value that changes while it is
+###    working (the main loop's tick count, a sensor's sweep count, ...), or
+###    None while it has nothing to do. Nothing is added to the hot paths, the
+###    monitor thread polls these every `interval` secs.
+###  - a watch whose value hasn't changed for `limit` secs, or whose thread
+###    died, is stalled: the stacks of the threads involved go to the log
+###  - a stall of a fatal watch (the main loop, savedata writes) also calls
+###    on_stall, which drives the outputs to their safe state, and stops
+###    feeding the hardware watchdog so the board reboots. If everything moves
+###    again before that, feeding resumes and the next stall trips it again.
+###  - the hardware watchdog (/dev/watchdog) is fed only while nothing fatal
+###    is stalled. SoftDevice stands in for it where there is none, or to try
+###    things out: it exits the process when it isn't fed in time.
+#####################################################################################
+
+
+class HardwareDevice:
+    """The Linux watchdog device, armed from open() until a clean close()"""
+
+    def __init__(self, path="/dev/watchdog"):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY)
+
+    def feed(self):
+        os.write(self._fd, b"\0")
+
+    def close(self):
+        """Disarm (the magic close) and close"""
+        if self._fd is not None:
+            os.write(self._fd, b"V")
+            os.close(self._fd)
+            self._fd = None
+
+
+class SoftDevice:
+    """In-process stand-in for the watchdog device"""
+
+    def __init__(self, timeout=15.0, on_expire=None):
+        self.timeout = timeout
+        self.on_expire = on_expire or self._expire
+        self.fed = 0
+        self._deadline = time.monotonic() + timeout
+        self._closed = threading.Event()
+        threading.Thread(target=self._run, name="softdog", daemon=True).start()
+
+    def feed(self):
+        self.fed += 1
+        self._deadline = time.monotonic() + self.timeout
+
+    def close(self):
+        self._closed.set()
+
+    def _run(self):
+        while not self._closed.wait(min(1.0, self.timeout / 4)):
+            if time.monotonic() > self._deadline:
+                self.on_expire()
+                return
+
+    @staticmethod
+    def _expire():
+        logging.critical("watchdog not fed, exiting")
+        logging.shutdown()
+        os._exit(70)            # for systemd to restart us, as a reboot would
+
+
+class Watch:
+    """One thing the watchdog keeps an eye on"""
+
+    def __init__(self, name, progress, limit, thread=None, fatal=False):
+        self.name = name
+        self.progress = progress
+        self.limit = limit
+        self.thread = thread
+        self.fatal = fatal
+        self.last = None
+        self.since = time.monotonic()   # when progress() last changed
+        self.stalled = False
+
+
+class Watchdog:
+
+    def __init__(self, device=None, interval=5.0, on_stall=None):
+        self.device = device            # HardwareDevice, SoftDevice or None
+        self.interval = interval
+        self.on_stall = on_stall        # called with the stalled watch names, once per fatal stall
+        self.watches = []
+        self.tripped = False            # in a fatal stall, the device is not fed until it's over
+        self._stop = threading.Event()
+        self._stalls = metrics.counter("bubbler_watchdog_stalls_total", "stalls detected by the watchdog")
+        metrics.gauge("bubbler_watchdog_stalled", "watches stalled right now",
+                      fn=lambda: sum(w.stalled for w in self.watches))
+
+    def watch(self, name, progress=None, limit=60.0, thread=None, fatal=False):
+        """Watch progress() for changes, and the thread (if any) for dying"""
+        self.watches.append(Watch(name, progress or (lambda: None), limit, thread, fatal))
+
+    def start(self):
+        threading.Thread(target=self._run, name="watchdog", daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop watching and disarm the device, e.g. at a clean exit"""
+        self._stop.set()
+        if self.device is not None:
+            self.device.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                # not fed after this, the device reboots us
+                logging.exception("watchdog failed")
+                return
+
+    def check(self, now=None):
+        """One pass over the watches, feeds the device if nothing fatal is stalled"""
+        now = time.monotonic() if now is None else now
+        stalled = []
+        for w in self.watches:
+            value = w.progress()
+            dead = w.thread is not None and not w.thread.is_alive()
+            if not dead and (value is None or value != w.last):
+                if w.stalled:
+                    logging.warning("watchdog: %s is moving again", w.name)
+                w.last, w.since, w.stalled = value, now, False
+                continue
+            if dead or now - w.since > w.limit:
+                if not w.stalled:
+                    w.stalled = True
+                    self._stalls.inc()
+                    why = "thread died" if dead else f"no progress for {now - w.since:.0f} s"
+                    logging.error("watchdog: %s stalled (%s)\n%s", w.name, why, self.stacks(w.thread))
+                stalled.append(w)
+
+        fatal = [w.name for w in stalled if w.fatal]
+        if fatal and not self.tripped:
+            self.tripped = True
+            logging.critical("watchdog: %s stalled, going to the safe state", ", ".join(fatal))
+            if self.on_stall:
+                self.on_stall(fatal)
+        elif not fatal and self.tripped:
+            # moving again before the device ran out, the next stall trips it again
+            self.tripped = False
+            logging.warning("watchdog: recovered, feeding again")
+        if not self.tripped and self.device is not None:
+            self.device.feed()
+        return stalled
+
+    @staticmethod
+    def stacks(thread=None):
+        """Stack of a thread, or of every thread, as text"""
+        frames = sys._current_frames()
+        threads = [thread] if thread is not None and thread.ident in frames else threading.enumerate()
+        dump = []
+        for t in threads:
+            frame = frames.get(t.ident)
+            if frame is not None:
+                dump.append(f"thread {t.name}:\n" + "".join(traceback.format_stack(frame)))
+        return "\n".join(dump)
@@ -0,0 +1,306 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from controller import SITE_DEFAULTS
+import statemachine
+
+#####################################################################################
+###  What-if: run-time and switch cycles for a grid of settings over recorded winters
+###
+###  python whatif.py templog/ dock2.csv --temp-to-constant=-10,-8,-6 --temp-from-constant=-6,-4
+###  python whatif.py templog/ --grid grid.json --csv results.csv
+###
+###  a trace is a temperature log directory (the templog setting) or a csv
+###  like simulate.py's (ts,air,...). The grid is every combination of the
+###  values given, json like {"temp_to_constant": [-10, -8], "alternation":
+###  [[["bubbler_2_off", 3], ["bubbler_1_on", 1800], ...]], "nightly": [...]},
+###  anything not given stays at the SITE_DEFAULTS value.
+###
+###  with auto_bubble on, the state is set by two hysteresis relays on the air
+###  temp: "cold" (on below temp_to_nightly, off above temp_from_nightly) and
+###  "very cold" (on below temp_to_constant, off above temp_from_constant).
+###  CONSTANT while very cold, NIGHTLY while only cold, IDLE otherwise, which
+###  is what statemachine.py does when the thresholds are in the usual order.
+###  Each relay is worked out once per threshold pair for the whole trace,
+###  then the combinations are evaluated a chunk at a time as (chunk x samples)
+###  arrays: the nightly table from the time of day, the alternation from the
+###  time since CONSTANT was entered. Readings are held between samples and
+###  a missing reading changes nothing, as in the controller. The filter's
+###  dwell is not modelled, so use filtered traces (a templog is).
+#####################################################################################
+
+IDLE, NIGHTLY, CONSTANT = statemachine.IDLE, statemachine.NIGHTLY, statemachine.CONSTANT
+THRESHOLDS = ("temp_to_nightly", "temp_from_nightly", "temp_to_constant", "temp_from_constant")
+BUBBLERS = ("bubbler_1", "bubbler_2")
+
+# what each action does to (bubbler_1, bubbler_2), None: left alone
+EFFECTS = {
+    "bubbler_1_on": (1, None), "bubbler_1_off": (0, None),
+    "bubbler_2_on": (None, 1), "bubbler_2_off": (None, 0),
+    "swap_to_bubbler_1": (1, 0), "swap_to_bubbler_2": (0, 1),
+}
+
+# combinations evaluated at once, each is a few bytes per sample per array
+CHUNK = 32
+
+
+#################################################################################
+###  Traces
+#################################################################################
+
+def load_trace(path, step):
+    """(name, sample times, air) on a regular grid of `step` secs, readings held between samples"""
+    if os.path.isdir(path):
+        from season import load_temps
+        temps = load_temps(path)
+        ts, air = np.asarray(temps["ts"], "f8"), np.asarray(temps["air"], "f8")
+    else:
+        from simulate import csv_trace
+        rows = [(t, np.nan if a is None else a) for t, a, _, _ in csv_trace(path)]
+        ts, air = (np.array(column, "f8") for column in zip(*rows))
+    if not len(ts):
+        raise ValueError(f"{path}: no samples")
+    grid = np.arange(ts[0], ts[-1] + step / 2, step)
+    held = air[np.searchsorted(ts, grid, side="right") - 1]
+    return os.path.basename(os.path.normpath(path)), grid, held
+
+
+def local_midnights(grid):
+    """Local midnight before each sample time"""
+    first = datetime.fromtimestamp(grid[0]).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = []
+    day = first
+    while day.timestamp() <= grid[-1]:
+        days.append(day.timestamp())
+        day += timedelta(days=1)
+    days = np.array(days)
+    return days[np.searchsorted(days, grid, side="right") - 1]
+
+
+#################################################################################
+###  Building blocks, each for the whole trace at once
+#################################################################################
+
+def relays(air, pairs):
+    """(pairs x samples) bool: on below `on`, off above `off`, unchanged otherwise"""
+    on = np.array([p[0] for p in pairs])[:, None]
+    off = np.array([p[1] for p in pairs])[:, None]
+    index = np.arange(air.size, dtype=np.int32)
+    setting = air < on                  # NaN compares False, so no change
+    changed = setting | (air > off)
+    last = np.maximum.accumulate(np.where(changed, index, -1), axis=1)
+    return np.where(last >= 0, np.take_along_axis(setting, np.maximum(last, 0), axis=1), False)
+
+
+def stretch_start(mask, grid):
+    """Time the current run of True in each row began (meaningless where mask is False)"""
+    index = np.arange(mask.shape[-1], dtype=np.int32)
+    began = mask.copy()
+    began[..., 1:] &= ~mask[..., :-1]
+    return grid[np.maximum.accumulate(np.where(began, index, 0), axis=-1)]
+
+
+def nightly_schedule(table, grid, midnight):
+    """For each bubbler: (time of the last scheduled event, on after it) at each sample"""
+    schedule = []
+    for b in range(len(BUBBLERS)):
+        events = sorted((_seconds(at), EFFECTS[action][b]) for at, action in table
+                        if EFFECTS[action][b] is not None)
+        if not events:
+            schedule.append((np.full(grid.size, -np.inf), np.zeros(grid.size, bool)))
+            continue
+        at = np.array([e[0] for e in events], "f8")
+        on = np.array([e[1] for e in events], bool)
+        k = np.searchsorted(at, grid - midnight, side="right") - 1
+        last = np.where(k >= 0, midnight + at[k], midnight - 86400 + at[-1])
+        schedule.append((last, on[k]))     # k == -1 is yesterday's last event
+    return schedule
+
+
+def alternation_outputs(table, constant, grid):
+    """For each bubbler: on at each sample from the alternation cycle, False outside CONSTANT"""
+    waits = np.array([float(wait) for _, wait in table])
+    offsets = np.concatenate(([0.0], np.cumsum(waits)[:-1]))
+    cycle = waits.sum()
+    since = np.where(constant, grid - stretch_start(constant, grid), 0.0)
+    phase = since % cycle
+    outputs = []
+    for b in range(len(BUBBLERS)):
+        steps = [(offsets[i], EFFECTS[action][b]) for i, (action, _) in enumerate(table)
+                 if EFFECTS[action][b] is not None]
+        if not steps:
+            outputs.append(np.zeros_like(constant))
+            continue
+        at = np.array([s[0] for s in steps])
+        on = np.array([s[1] for s in steps], bool)
+        k = np.searchsorted(at, phase, side="right") - 1
+        # before this bubbler's first step in the cycle: the previous cycle's last step,
+        # or off in the first cycle (leaving NIGHTLY / IDLE turned it off)
+        state = np.where(k >= 0, on[k], np.where(since >= cycle, on[-1], False))
+        outputs.append(constant & state)
+    return outputs
+
+
+def _seconds(hhmm):
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+#################################################################################
+###  The grid
+#################################################################################
+
+def combinations(grid):
+    """Every combination of the grid's values, SITE_DEFAULTS for anything not in it"""
+    unknown = set(grid) - set(THRESHOLDS) - {"nightly", "alternation"}
+    if unknown:
+        raise ValueError(f"can't vary {', '.join(sorted(unknown))}")
+    keys = THRESHOLDS + ("nightly", "alternation")
+    values = [grid.get(key) or [SITE_DEFAULTS[key]] for key in keys]
+    for combo in itertools.product(*values):
+        settings = dict(zip(keys, combo))
+        if not (settings["temp_to_constant"] < settings["temp_from_constant"] <= settings["temp_from_nightly"]
+                and settings["temp_to_constant"] <= settings["temp_to_nightly"] < settings["temp_from_nightly"]):
+            continue        # thresholds out of order, the state machine wouldn't be two relays
+        yield settings
+
+
+def evaluate(grid, air, settings, step):
+    """[{settings..., results...}] for every settings dict, over one trace"""
+    settings = list(settings)
+    if not settings:
+        return []
+    midnight = local_midnights(grid)
+
+    def unique(values):
+        keys = []
+        for v in values:
+            if v not in keys:
+                keys.append(v)
+        return keys, [keys.index(v) for v in values]
+
+    cold_pairs, cold_of = unique([(s["temp_to_nightly"], s["temp_from_nightly"]) for s in settings])
+    very_pairs, very_of = unique([(s["temp_to_constant"], s["temp_from_constant"]) for s in settings])
+    nightly_tables, nightly_of = unique([s["nightly"] for s in settings])
+    alt_tables, alt_of = unique([s["alternation"] for s in settings])
+
+    cold = relays(air, cold_pairs)
+    very = relays(air, very_pairs)
+    entries = (very[:, 1:] & ~very[:, :-1]).sum(axis=1) + very[:, 0]
+    schedules = [nightly_schedule(t, grid, midnight) for t in nightly_tables]
+    alternations = {}
+    for j, a in set(zip(very_of, alt_of)):
+        alternations[(j, a)] = alternation_outputs(alt_tables[a], very[j], grid)
+
+    results = []
+    for first in range(0, len(settings), CHUNK):
+        rows = range(first, min(first + CHUNK, len(settings)))
+        c = cold[[cold_of[r] for r in rows]]
+        v = very[[very_of[r] for r in rows]]
+        state = np.where(v, CONSTANT, np.where(c, NIGHTLY, IDLE)).astype(np.int8)
+        nightly = state == NIGHTLY
+        since = stretch_start(nightly, grid)
+        transitions = np.count_nonzero(np.diff(state, axis=1), axis=1) + (state[:, 0] != IDLE)
+
+        run, cycles = [], []
+        for b in range(len(BUBBLERS)):
+            last = np.stack([schedules[nightly_of[r]][b][0] for r in rows])
+            on_after = np.stack([schedules[nightly_of[r]][b][1] for r in rows])
+            by_table = nightly & on_after & (last >= since)
+            by_cycle = np.stack([alternations[(very_of[r], alt_of[r])][b] for r in rows])
+            on = by_table | by_cycle
+            run.append(on.sum(axis=1) * step / 3600)
+            cycles.append((on[:, 1:] & ~on[:, :-1]).sum(axis=1) + on[:, 0])
+
+        for i, r in enumerate(rows):
+            counts = np.bincount(state[i], minlength=CONSTANT + 1) * step / 3600
+            result = {key: settings[r][key] for key in THRESHOLDS}
+            result["nightly"] = settings[r]["nightly"]
+            result["alternation"] = settings[r]["alternation"]
+            result.update({
+                "transitions": int(transitions[i]),
+                "constant_entries": int(entries[very_of[r]]),
+                "state_hours": {statemachine.STATE_NAMES[s]: round(float(counts[s]), 1)
+                                for s in (IDLE, NIGHTLY, CONSTANT)},
+                "run_hours": {name: round(float(run[b][i]), 1) for b, name in enumerate(BUBBLERS)},
+                "switch_cycles": {name: int(cycles[b][i]) for b, name in enumerate(BUBBLERS)},
+            })
+            result["total_run_hours"] = round(sum(result["run_hours"].values()), 1)
+            results.append(result)
+    return results
+
+
+#################################################################################
+###  Command line
+#################################################################################
+
+def _floats(text):
+    return [float(x) for x in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bubbler settings over recorded temperatures")
+    parser.add_argument("traces", nargs="+", help="templog directories or csv traces, one per dock")
+    parser.add_argument("--grid", help="json file of setting -> list of values")
+    for key in THRESHOLDS:
+        parser.add_argument("--" + key.replace("_", "-"), type=_floats, help="comma separated values")
+    parser.add_argument("--alternation-minutes", type=_floats,
+                        help="bubbler run time per CONSTANT alternation step, comma separated")
+    parser.add_argument("--step", type=float, default=60, help="evaluation resolution (s)")
+    parser.add_argument("--top", type=int, default=5, help="settings to show per dock, least run-time first")
+    parser.add_argument("--csv", help="write every result here")
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    for key in THRESHOLDS:
+        if getattr(args, key):
+            grid[key] = getattr(args, key)
+    if args.alternation_minutes:
+        grid["alternation"] = [[["bubbler_2_off", 3], ["bubbler_1_on", m * 60], ["bubbler_1_off", 3],
+                                ["bubbler_2_on", m * 60]] for m in args.alternation_minutes]
+    settings = list(combinations(grid))
+    print(f"{len(settings)} combinations")
+
+    rows = []
+    for path in args.traces:
+        start = datetime.now()
+        name, times, air = load_trace(path, args.step)
+        results = evaluate(times, air, settings, args.step)
+        seconds = (datetime.now() - start).total_seconds()
+        print(f"\n{name}: {times.size} samples, {len(results)} combinations in {seconds:.1f} s")
+        for result in sorted(results, key=lambda r: r["total_run_hours"])[:args.top]:
+            print(" ", "  ".join(f"{key} {result[key]:g}" for key in THRESHOLDS),
+                  f"| cycle {sum(wait for _, wait in result['alternation']) / 60:g} min",
+                  f"| run {result['total_run_hours']} h", result["run_hours"],
+                  f"| CONSTANT x{result['constant_entries']}", result["switch_cycles"])
+        rows.extend(dict(result, site=name) for result in results)
+
+    if args.csv:
+        columns = ["site", *THRESHOLDS, "nightly", "alternation", "transitions", "constant_entries",
+                   "idle_hours", "nightly_hours", "constant_hours", "bubbler_1_hours", "bubbler_2_hours",
+                   "bubbler_1_cycles", "bubbler_2_cycles", "total_run_hours"]
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for r in rows:
+                writer.writerow([r["site"], *(r[key] for key in THRESHOLDS),
+                                 json.dumps(r["nightly"]), json.dumps(r["alternation"]),
+                                 r["transitions"], r["constant_entries"],
+                                 r["state_hours"]["Idle"], r["state_hours"]["Nightly"],
+                                 r["state_hours"]["Constant"],
+                                 r["run_hours"]["bubbler_1"], r["run_hours"]["bubbler_2"],
+                                 r["switch_cycles"]["bubbler_1"], r["switch_cycles"]["bubbler_2"],
+                                 r["total_run_hours"]])
+
+
+if __name__ == "__main__":
+    main()